@@ -1,19 +1,49 @@
 import asyncio
+import atexit
+import bisect
+import functools
+import heapq
+import io
+import itertools
 import json
 import logging
 import os
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
 
+try:
+    # Регулярные выражения правил выполняются RE2 за линейное время (пакет google-re2)
+    import re2
+except ImportError:
+    re2 = None
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (Application, CallbackQueryHandler, CommandHandler,
                           ContextTypes, ConversationHandler, MessageHandler,
-                          filters)
-from telethon import TelegramClient, events
+                          TypeHandler, filters)
+from telegram.error import RetryAfter
+from telethon import TelegramClient, events, utils
+from telethon.errors import FloodWaitError
 from telethon.tl.functions.channels import LeaveChannelRequest
 from telethon.tl.functions.contacts import BlockRequest
 from telethon.tl.functions.account import UpdateNotifySettingsRequest
-from telethon.tl.types import InputNotifyPeer, InputPeerNotifySettings
+from telethon.tl.functions.folders import EditPeerFoldersRequest
+from telethon.tl.functions.messages import SearchRequest, SendMessageRequest
+from telethon.tl.types import (Channel, InputFolderPeer, InputMessagesFilterEmpty,
+                               InputNotifyPeer, InputPeerNotifySettings, InputPeerSelf,
+                               InputReplyToMessage, MessageMediaDocument, MessageMediaPhoto,
+                               NotifyPeer, PeerChannel, PeerChat, UpdateChannel,
+                               UpdateChat, UpdateFolderPeers, UpdateNotifySettings,
+                               UpdateUser, UpdateUserName)
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,343 +52,2934 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Состояния диалога
-START, PHONE, CODE, CODE_INPUT, OPERATIONAL = range(5)
+# Состояния диалога
+START, PHONE, CODE, CODE_INPUT, OPERATIONAL = range(5)
+
+# Константы для API Telegram
+TELEGRAM_BOT_TOKEN = os.environ.get('6260969950:AAHCrisYmgFrxKvO-PzlMdU03IUF4aX6fYM')
+API_ID = int(os.environ.get('TELEGRAM_API_ID', '26540663'))  # With default value
+API_HASH = os.environ.get('38d8a00867f4e1b561c108eb487bcea7')
+
+# Основная директория для хранения данных пользователей
+DATA_DIR = Path('data')
+if not DATA_DIR.exists():
+    DATA_DIR.mkdir()
+
+# Словарь для отслеживания активных клиентов
+active_clients = {}
+
+# Функции для работы с хранилищем
+
+def get_user_config_path(user_id):
+    """Получить путь к файлу конфигурации пользователя"""
+    return DATA_DIR / f"user_{user_id}_config.json"
+
+def get_session_path(user_id):
+    """Получить путь к файлу сессии Telethon для пользователя"""
+    return str(DATA_DIR / f"user_{user_id}")
+
+# Хранилища конфигураций пользователей
+
+# Тип хранилища: 'sqlite' (по умолчанию) или 'json' (отдельный файл на пользователя)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+STORAGE_DB_PATH = DATA_DIR / 'storage.db'
+# Количество изменений, после которого транзакция фиксируется немедленно
+STORAGE_BATCH_SIZE = int(os.environ.get('STORAGE_BATCH_SIZE', '50'))
+# Максимальная задержка фиксации накопленных изменений в секундах
+STORAGE_COMMIT_INTERVAL = float(os.environ.get('STORAGE_COMMIT_INTERVAL', '0.5'))
+
+class JsonConfigStorage:
+    """Хранилище конфигураций в отдельных JSON файлах с атомарной записью"""
+    
+    def load(self, user_id):
+        """Прочитать конфигурацию пользователя"""
+        config_path = get_user_config_path(user_id)
+        try:
+            with open(config_path, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            return {}
+    
+    def save(self, user_id, config):
+        """Записать конфигурацию через временный файл и атомарное переименование"""
+        config_path = get_user_config_path(user_id)
+        tmp_path = config_path.with_suffix('.json.tmp')
+        
+        with open(tmp_path, 'w') as f:
+            json.dump(config, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, config_path)
+    
+    def stamp(self, user_id):
+        """Отметка состояния файла конфигурации (None, если файла нет)"""
+        try:
+            stat = get_user_config_path(user_id).stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+    
+    def iter_configs(self):
+        """Перебрать конфигурации всех пользователей"""
+        for config_path in DATA_DIR.glob('user_*_config.json'):
+            try:
+                user_id = int(config_path.name[len('user_'):-len('_config.json')])
+            except ValueError:
+                continue
+            yield user_id, self.load(user_id)
+    
+    def flush(self):
+        """Запись выполняется сразу, фиксировать нечего"""
+    
+    def close(self):
+        """Закрыть хранилище"""
+
+class BatchedSqliteStore:
+    """База SQLite (WAL), изменения в которой фиксируются пакетами"""
+    
+    # Прагмы, которые должны выполниться до создания таблиц
+    init_pragmas = ()
+    
+    def __init__(self, db_path, batch_size=STORAGE_BATCH_SIZE, commit_interval=STORAGE_COMMIT_INTERVAL):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._flush_handle = None
+        
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        for pragma in self.init_pragmas:
+            self._conn.execute(pragma)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+    
+    def _written(self):
+        """Учесть изменение (вызывается под блокировкой): полный пакет фиксируется сразу"""
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+        else:
+            self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """Запланировать отложенную фиксацию в цикле событий"""
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет цикла событий - фиксируем сразу
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.commit_interval, self.flush)
+    
+    def flush(self):
+        """Зафиксировать накопленные изменения"""
+        with self._lock:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            if self._pending:
+                self._conn.commit()
+                self._pending = 0
+    
+    def close(self):
+        """Зафиксировать изменения и закрыть соединение"""
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+class SqliteConfigStorage(BatchedSqliteStore):
+    """Хранилище конфигураций в одной базе SQLite (WAL) с пакетной фиксацией"""
+    
+    def __init__(self, db_path=STORAGE_DB_PATH, batch_size=STORAGE_BATCH_SIZE,
+                 commit_interval=STORAGE_COMMIT_INTERVAL):
+        super().__init__(db_path, batch_size, commit_interval)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_config ('
+            'user_id INTEGER PRIMARY KEY, config TEXT NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+        )
+        self._conn.commit()
+    
+    def load(self, user_id):
+        """Прочитать конфигурацию пользователя (включая незафиксированные изменения)"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT config FROM user_config WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        if row is None:
+            return {}
+        try:
+            return json.loads(row[0])
+        except json.JSONDecodeError:
+            return {}
+    
+    def save(self, user_id, config):
+        """Записать конфигурацию; фиксация выполняется пакетами"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO user_config (user_id, config) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET config = excluded.config',
+                (user_id, json.dumps(config))
+            )
+            self._written()
+    
+    def iter_configs(self):
+        """Перебрать конфигурации всех пользователей"""
+        with self._lock:
+            rows = self._conn.execute('SELECT user_id, config FROM user_config').fetchall()
+        for user_id, config in rows:
+            try:
+                yield user_id, json.loads(config)
+            except json.JSONDecodeError:
+                continue
+    
+    def stamp(self, user_id):
+        """Версия базы: меняется при фиксации изменений другим соединением"""
+        with self._lock:
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+    
+    def migrate_json_configs(self, data_dir=DATA_DIR):
+        """Однократный импорт файлов user_*_config.json в базу"""
+        with self._lock:
+            done = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'json_migrated'"
+            ).fetchone()
+            if done:
+                return 0
+            
+            imported = 0
+            for config_path in data_dir.glob('user_*_config.json'):
+                try:
+                    user_id = int(config_path.name[len('user_'):-len('_config.json')])
+                    with open(config_path, 'r') as f:
+                        config = json.load(f)
+                except (ValueError, OSError) as e:
+                    logger.warning(f"Пропущен файл конфигурации {config_path}: {e}")
+                    continue
+                
+                self._conn.execute(
+                    'INSERT OR IGNORE INTO user_config (user_id, config) VALUES (?, ?)',
+                    (user_id, json.dumps(config))
+                )
+                imported += 1
+            
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')"
+            )
+            self._conn.commit()
+        
+        if imported:
+            logger.info(f"Импортировано конфигураций из JSON файлов: {imported}")
+        return imported
+
+def create_config_storage(backend=STORAGE_BACKEND):
+    """Создать хранилище конфигураций выбранного типа"""
+    if backend == 'json':
+        return JsonConfigStorage()
+    if backend == 'sqlite':
+        storage = SqliteConfigStorage()
+        storage.migrate_json_configs()
+        atexit.register(storage.close)
+        return storage
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+config_storage = create_config_storage()
+
+# Кэш конфигураций пользователей
+
+# Максимальное количество конфигураций, хранимых в памяти
+CONFIG_CACHE_SIZE = int(os.environ.get('CONFIG_CACHE_SIZE', '1024'))
+
+class UserConfigCache:
+    """Кэш конфигураций пользователей в памяти с вытеснением LRU"""
+    
+    def __init__(self, max_size=CONFIG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, user_id, stamp):
+        """Вернуть конфигурацию, если она есть в кэше и хранилище не изменилось"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, user_id, stamp, config):
+        """Сохранить конфигурацию в кэше с отметкой состояния хранилища"""
+        self._entries[user_id] = (stamp, config)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, user_id=None):
+        """Удалить запись пользователя (или все записи) из кэша"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+    
+    def stats(self):
+        """Счетчики попаданий и промахов кэша"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
+
+config_cache = UserConfigCache()
+
+def get_config_cache_stats():
+    """Получить статистику кэша конфигураций"""
+    return config_cache.stats()
+
+def read_user_config(user_id):
+    """Прочитать конфигурацию пользователя через кэш (результат нельзя изменять)"""
+    stamp = config_storage.stamp(user_id)
+    
+    config = config_cache.get(user_id, stamp)
+    if config is not None:
+        return config
+    
+    config = config_storage.load(user_id)
+    config_cache.put(user_id, stamp, config)
+    return config
+
+def update_user_config(user_id, **changes):
+    """Изменить поля конфигурации пользователя и обновить кэш"""
+    config = dict(read_user_config(user_id))
+    config.update(changes)
+    config_storage.save(user_id, config)
+    config_cache.put(user_id, config_storage.stamp(user_id), config)
+
+def save_session(user_id):
+    """Пометить, что у пользователя есть действительная сессия"""
+    update_user_config(user_id, has_session=True)
+
+def load_session(user_id):
+    """Проверить, есть ли у пользователя действительная сессия"""
+    return read_user_config(user_id).get('has_session', False)
+
+def save_user_mode(user_id, mode):
+    """Сохранить выбранный пользователем режим работы"""
+    update_user_config(user_id, mode=mode)
+
+def get_user_mode(user_id):
+    """Получить выбранный пользователем режим работы"""
+    return read_user_config(user_id).get('mode', 1)  # По умолчанию режим 1
+
+# Кэш сущностей Telegram (отправители и чаты)
+
+# Максимальное количество сущностей в кэше одного клиента
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', '2048'))
+# Время жизни записи в кэше сущностей в секундах
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', '600'))
+
+# Разрешенная сущность: отображаемое имя, признак бота, признак канала и входной peer
+CachedEntity = namedtuple('CachedEntity', ['peer_id', 'name', 'is_bot', 'is_channel', 'input_peer'])
+
+class EntityCache:
+    """Кэш сущностей клиента с вытеснением LRU и ограничением времени жизни"""
+    
+    def __init__(self, max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, peer_id):
+        """Вернуть сущность, если она есть в кэше и не устарела"""
+        entry = self._entries.get(peer_id)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(peer_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(peer_id)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, entity):
+        """Сохранить сущность в кэше"""
+        self._entries[entity.peer_id] = (time.monotonic() + self.ttl, entity)
+        self._entries.move_to_end(entity.peer_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, peer_id):
+        """Удалить сущность из кэша"""
+        self._entries.pop(peer_id, None)
+    
+    def stats(self):
+        """Счетчики попаданий и промахов кэша"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+# Кэши сущностей для каждого клиента
+entity_caches = weakref.WeakKeyDictionary()
+
+def get_entity_cache(client):
+    """Получить кэш сущностей клиента"""
+    cache = entity_caches.get(client)
+    if cache is None:
+        cache = entity_caches[client] = EntityCache()
+    return cache
+
+def make_cached_entity(entity):
+    """Построить запись кэша из объекта пользователя, чата или канала"""
+    try:
+        input_peer = utils.get_input_peer(entity)
+    except TypeError:
+        input_peer = None
+    return CachedEntity(
+        peer_id=utils.get_peer_id(entity),
+        name=get_sender_name(entity),
+        is_bot=bool(getattr(entity, 'bot', False)),
+        is_channel=isinstance(entity, Channel) and not entity.megagroup,
+        input_peer=input_peer
+    )
+
+async def resolve_sender(client, event):
+    """Получить отправителя события (для каналов - сам канал) через кэш"""
+    cache = get_entity_cache(client)
+    peer_id = event.chat_id if event.is_channel else event.sender_id
+    
+    cached = cache.get(peer_id)
+    if cached is not None:
+        return cached
+    
+    entity = await (event.get_chat() if event.is_channel else event.get_sender())
+    cached = make_cached_entity(entity)
+    if cached.input_peer is None:
+        cached = cached._replace(input_peer=await (
+            event.get_input_chat() if event.is_channel else event.get_input_sender()
+        ))
+    cache.put(cached)
+    return cached
+
+async def resolve_chat(client, event):
+    """Получить чат события через кэш (для личных сообщений совпадает с отправителем)"""
+    cache = get_entity_cache(client)
+    
+    cached = cache.get(event.chat_id)
+    if cached is not None:
+        return cached
+    
+    entity = await event.get_chat()
+    cached = make_cached_entity(entity)
+    if cached.input_peer is None:
+        cached = cached._replace(input_peer=await event.get_input_chat())
+    cache.put(cached)
+    return cached
+
+def get_updated_peer_id(update):
+    """Получить ID сущности, которую затрагивает обновление"""
+    if isinstance(update, (UpdateUserName, UpdateUser)):
+        return update.user_id
+    if isinstance(update, UpdateChannel):
+        return utils.get_peer_id(PeerChannel(update.channel_id))
+    if isinstance(update, UpdateChat):
+        return utils.get_peer_id(PeerChat(update.chat_id))
+    return None
+
+# Индекс запущенных ботов
+
+class StartedBotsIndex:
+    """Индекс ботов, которым пользователь отправлял /start, с сохранением в конфигурации"""
+    
+    def __init__(self, user_id):
+        config = read_user_config(user_id)
+        self.user_id = user_id
+        self.started = set(config.get('started_bots', []))
+        # Боты, история которых уже проверена однократной догрузкой
+        self.checked = set(config.get('checked_bots', []))
+    
+    def lookup(self, bot_id):
+        """True/False, если ответ известен; None, если бот еще не проверялся"""
+        if bot_id in self.started:
+            return True
+        if bot_id in self.checked:
+            return False
+        return None
+    
+    def add(self, bot_id):
+        """Отметить бота как запущенного"""
+        if bot_id not in self.started:
+            self.started.add(bot_id)
+            self.checked.add(bot_id)
+            self._save()
+    
+    def mark_checked(self, bot_id, started):
+        """Сохранить результат однократной проверки истории"""
+        self.checked.add(bot_id)
+        if started:
+            self.started.add(bot_id)
+        self._save()
+    
+    def _save(self):
+        update_user_config(
+            self.user_id,
+            started_bots=sorted(self.started),
+            checked_bots=sorted(self.checked)
+        )
+
+# Индексы запущенных ботов по ID пользователя
+started_bots_indexes = {}
+
+def get_started_bots_index(user_id):
+    """Получить индекс запущенных ботов пользователя"""
+    index = started_bots_indexes.get(user_id)
+    if index is None:
+        index = started_bots_indexes[user_id] = StartedBotsIndex(user_id)
+    return index
+
+async def has_started_bot(client, user_id, bot):
+    """Проверить, запускал ли пользователь бота (история загружается только один раз)"""
+    index = get_started_bots_index(user_id)
+    started = index.lookup(bot.peer_id)
+    
+    if started is None:
+        # Однократная догрузка: поиск исходящего /start по всей истории чата
+        request = SearchRequest(
+            peer=bot.input_peer, q='/start', filter=InputMessagesFilterEmpty(),
+            min_date=None, max_date=None, offset_id=0, add_offset=0, limit=10,
+            max_id=0, min_id=0, hash=0, from_id=InputPeerSelf()
+        )
+        found = await get_request_executor(client).call(
+            'get_messages',
+            lambda: client(request, flood_sleep_threshold=0),
+            priority=REQUEST_NORMAL,
+            key=('start_search', bot.peer_id)
+        )
+        started = any(
+            getattr(msg, 'out', False) and (getattr(msg, 'message', None) or '').startswith('/start')
+            for msg in found.messages
+        )
+        index.mark_checked(bot.peer_id, started)
+    
+    return started
+
+# Планировщик исходящих уведомлений Bot API
+
+# Приоритеты уведомлений (меньше - важнее)
+NOTIFY_CONTENT, NOTIFY_STATUS, NOTIFY_ERROR = range(3)
+
+# Общий лимит Bot API (сообщений в секунду) и лимиты для одного чата
+BOT_API_GLOBAL_RATE = float(os.environ.get('BOT_API_GLOBAL_RATE', '25'))
+BOT_API_CHAT_RATE = float(os.environ.get('BOT_API_CHAT_RATE', '1'))
+BOT_API_CHAT_BURST = int(os.environ.get('BOT_API_CHAT_BURST', '3'))
+# Максимальное количество ожидающих уведомлений для одного чата
+NOTIFY_QUEUE_LIMIT = int(os.environ.get('NOTIFY_QUEUE_LIMIT', '500'))
+
+class TokenBucket:
+    """Ограничитель частоты по алгоритму корзины токенов"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def pause(self, seconds):
+        """Приостановить выдачу токенов (например, после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        """Дождаться и забрать один токен"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class NotificationScheduler:
+    """Очередь исходящих уведомлений с ограничением частоты и приоритетами"""
+    
+    def __init__(self, global_rate=BOT_API_GLOBAL_RATE, chat_rate=BOT_API_CHAT_RATE,
+                 chat_burst=BOT_API_CHAT_BURST, queue_limit=NOTIFY_QUEUE_LIMIT):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.queue_limit = queue_limit
+        self._chat_buckets = {}
+        self._queues = {}
+        self._workers = {}
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=1000)
+        # Количество вытесненных уведомлений, о которых еще не сообщено, по ID чата
+        self._skipped = {}
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+    
+    def submit(self, bot, chat_id, text, priority=NOTIFY_STATUS, media=None):
+        """Поставить уведомление в очередь; future завершается True после отправки"""
+        done = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, [])
+        heapq.heappush(queue, (priority, next(self._seq), time.monotonic(), bot, text, media, done))
+        
+        if len(queue) > self.queue_limit:
+            # Вытесняется наименее важное и самое новое уведомление; содержимое сообщений не вытесняется
+            dropped = max(queue)
+            if dropped[0] != NOTIFY_CONTENT:
+                queue.remove(dropped)
+                heapq.heapify(queue)
+                dropped[-1].set_result(False)
+                self.dropped += 1
+                logger.warning(f"Очередь уведомлений чата {chat_id} переполнена, пропущено: {dropped[4]}")
+                
+                # Вместо пропущенных уведомлений отправляется одна сводная запись
+                if chat_id not in self._skipped:
+                    heapq.heappush(queue, (NOTIFY_CONTENT, next(self._seq), time.monotonic(), bot, None, None,
+                                           asyncio.get_running_loop().create_future()))
+                self._skipped[chat_id] = self._skipped.get(chat_id, 0) + 1
+        
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return done
+    
+    async def _send(self, bot, chat_id, text, media):
+        """Отправить текст или медиафайл с подписью"""
+        if media is None:
+            return await bot.send_message(chat_id, text)
+        
+        kind, data, filename = media
+        method, argument = MEDIA_SEND_METHODS.get(kind, MEDIA_SEND_METHODS['document'])
+        return await getattr(bot, method)(
+            chat_id,
+            **{argument: data},
+            caption=text[:MEDIA_CAPTION_LIMIT],
+            filename=filename
+        )
+    
+    async def _drain(self, chat_id):
+        """Отправка уведомлений одного чата по порядку приоритетов"""
+        queue = self._queues[chat_id]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        
+        try:
+            while queue:
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                
+                item = heapq.heappop(queue)
+                priority, _, enqueued, bot, text, media, done = item
+                if text is None:
+                    text = f"Пропущено уведомлений из-за переполнения очереди: {self._skipped.pop(chat_id, 0)}"
+                    item = (priority, item[1], enqueued, bot, text, media, done)
+                try:
+                    await self._send(bot, chat_id, text, media)
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning(f"Превышен лимит Bot API для чата {chat_id}, ожидание {retry_after} с")
+                    bucket.pause(retry_after)
+                    heapq.heappush(queue, item)
+                    self.retries += 1
+                    continue
+                except Exception as e:
+                    # Ошибка отправки не порождает новых уведомлений
+                    logger.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+                    self.failed += 1
+                    done.set_result(False)
+                    continue
+                
+                self.sent += 1
+                done.set_result(True)
+                self._waits.append(time.monotonic() - enqueued)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                self._queues.pop(chat_id, None)
+    
+    def close(self):
+        """Остановить отправку (неотправленные уведомления отбрасываются); возвращает отмененные задачи"""
+        tasks = list(self._workers.values())
+        for task in tasks:
+            task.cancel()
+        for queue in self._queues.values():
+            for item in queue:
+                if not item[-1].done():
+                    item[-1].set_result(False)
+        return tasks
+    
+    def depth(self):
+        """Количество уведомлений, ожидающих отправки"""
+        return sum(len(queue) for queue in self._queues.values())
+    
+    async def flush(self, timeout=None):
+        """Дождаться отправки всех поставленных в очередь уведомлений"""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+    
+    def stats(self):
+        """Метрики очереди: глубина, количество отправок и время ожидания"""
+        waits = sorted(self._waits)
+        return {
+            'depth': self.depth(),
+            'chats': len(self._queues),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'retries': self.retries,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+notification_scheduler = NotificationScheduler()
+
+# Методы Bot API для отправки медиафайлов: тип -> (метод, имя аргумента)
+MEDIA_SEND_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'voice': ('send_voice', 'voice'),
+    'audio': ('send_audio', 'audio'),
+    'document': ('send_document', 'document'),
+}
+# Максимальная длина подписи к медиафайлу в Bot API
+MEDIA_CAPTION_LIMIT = 1024
+# Максимальная длина текстового сообщения в Bot API
+MESSAGE_TEXT_LIMIT = 4096
+
+def notify(bot, chat_id, text, priority=NOTIFY_STATUS):
+    """Отправить уведомление пользователю через общую очередь"""
+    notification_scheduler.submit(bot, chat_id, text, priority)
+
+# Метрики обработки входящих сообщений
+
+# Границы корзин гистограммы задержек в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Количество последних измерений для расчета перцентилей
+LATENCY_SAMPLES = int(os.environ.get('LATENCY_SAMPLES', '2048'))
+# Файл для экспорта метрик в текстовом формате Prometheus (пусто - экспорт отключен)
+METRICS_EXPORT_PATH = os.environ.get('METRICS_EXPORT_PATH', '')
+METRICS_EXPORT_INTERVAL = float(os.environ.get('METRICS_EXPORT_INTERVAL', '15'))
+
+class StageMetrics:
+    """Счетчики и гистограмма задержек одного этапа обработки"""
+    
+    def __init__(self):
+        self.ok = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+    
+    def observe(self, elapsed, ok):
+        """Учесть одно выполнение этапа"""
+        if ok:
+            self.ok += 1
+        else:
+            self.errors += 1
+        self.total_time += elapsed
+        self.samples.append(elapsed)
+        index = bisect.bisect_left(LATENCY_BUCKETS, elapsed)
+        if index < len(self.buckets):
+            self.buckets[index] += 1
+    
+    def percentiles(self, *quantiles):
+        """Перцентили задержки по последним измерениям"""
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0] * len(quantiles)
+        return [samples[min(len(samples) - 1, int(len(samples) * q))] for q in quantiles]
+
+class PipelineMetrics:
+    """Метрики этапов обработки входящих сообщений по режимам"""
+    
+    def __init__(self):
+        self.stages = {}
+    
+    def observe(self, mode, stage, elapsed, ok=True):
+        """Учесть выполнение этапа в указанном режиме"""
+        metrics = self.stages.get((mode, stage))
+        if metrics is None:
+            metrics = self.stages[(mode, stage)] = StageMetrics()
+        metrics.observe(elapsed, ok)
+    
+    @contextmanager
+    def stage(self, mode, stage):
+        """Измерить время выполнения этапа (исключение считается ошибкой)"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(mode, stage, time.perf_counter() - started, False)
+            raise
+        self.observe(mode, stage, time.perf_counter() - started, True)
+    
+    def render_prometheus(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            '# HELP bot_stage_duration_seconds Время выполнения этапа обработки сообщения',
+            '# TYPE bot_stage_duration_seconds histogram',
+        ]
+        for (mode, stage), metrics in sorted(self.stages.items(), key=lambda item: str(item[0])):
+            labels = f'mode="{mode}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                cumulative += count
+                lines.append(f'bot_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            count = metrics.ok + metrics.errors
+            lines.append(f'bot_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'bot_stage_duration_seconds_sum{{{labels}}} {metrics.total_time}')
+            lines.append(f'bot_stage_duration_seconds_count{{{labels}}} {count}')
+        
+        lines += [
+            '# HELP bot_stage_total Количество выполнений этапа по результату',
+            '# TYPE bot_stage_total counter',
+        ]
+        for (mode, stage), metrics in sorted(self.stages.items(), key=lambda item: str(item[0])):
+            labels = f'mode="{mode}",stage="{stage}"'
+            lines.append(f'bot_stage_total{{{labels},result="ok"}} {metrics.ok}')
+            lines.append(f'bot_stage_total{{{labels},result="error"}} {metrics.errors}')
+        
+        return '\n'.join(lines) + '\n'
+
+pipeline_metrics = PipelineMetrics()
+
+def render_metrics():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    gauges = {
+        'bot_config_cache_hits': config_cache.hits,
+        'bot_config_cache_misses': config_cache.misses,
+        'bot_notify_queue_depth': notification_scheduler.depth(),
+        'bot_notify_sent': notification_scheduler.sent,
+        'bot_notify_retries': notification_scheduler.retries,
+        'bot_auto_reply_suppressed': reply_cooldown.suppressed,
+    }
+    lines = []
+    for name, value in gauges.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return pipeline_metrics.render_prometheus() + '\n'.join(lines) + '\n'
+
+def write_metrics_file(path):
+    """Атомарно записать метрики в файл"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render_metrics())
+    os.replace(tmp_path, path)
+
+async def run_metrics_exporter(path, interval):
+    """Периодическая запись метрик в файл"""
+    while True:
+        try:
+            write_metrics_file(path)
+        except OSError as e:
+            logger.error(f"Не удалось записать метрики в {path}: {e}")
+        await asyncio.sleep(interval)
+
+metrics_exporter_task = None
+
+def start_metrics_exporter():
+    """Запустить экспорт метрик в файл, если он включен"""
+    global metrics_exporter_task
+    if METRICS_EXPORT_PATH and metrics_exporter_task is None:
+        metrics_exporter_task = asyncio.create_task(
+            run_metrics_exporter(METRICS_EXPORT_PATH, METRICS_EXPORT_INTERVAL)
+        )
+
+# Состояние чатов: отключенные уведомления и архив
+
+# Окно накопления чатов для одного запроса архивирования в секундах
+ARCHIVE_BATCH_WINDOW = float(os.environ.get('ARCHIVE_BATCH_WINDOW', '1.0'))
+
+class DialogStateTracker:
+    """Учет заглушенных и архивированных чатов клиента с пакетным архивированием"""
+    
+    def __init__(self, window=ARCHIVE_BATCH_WINDOW):
+        self.window = window
+        self.muted = set()
+        self.archived = set()
+        self._pending = {}
+        self._flush_task = None
+    
+    def begin_mute(self, peer_id):
+        """Отметить чат как заглушенный; False, если он уже заглушен"""
+        if peer_id in self.muted:
+            return False
+        self.muted.add(peer_id)
+        return True
+    
+    def set_muted(self, peer_id, muted):
+        """Изменить признак отключенных уведомлений"""
+        if muted:
+            self.muted.add(peer_id)
+        else:
+            self.muted.discard(peer_id)
+    
+    def mute_done(self, peer_id, name, future):
+        """Обработать завершение фонового запроса отключения уведомлений"""
+        if future.cancelled() or future.exception() is not None:
+            self.muted.discard(peer_id)
+            if not future.cancelled():
+                logger.error(f"Ошибка при отключении уведомлений для {name}: {future.exception()}")
+        else:
+            logger.info(f"Отключены уведомления для: {name}")
+    
+    def archive(self, client, peer_id, input_peer):
+        """Добавить чат в ближайший пакет архивирования, если он еще не в архиве"""
+        if peer_id in self.archived or peer_id in self._pending:
+            return
+        self._pending[peer_id] = input_peer
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(client))
+    
+    async def _flush_later(self, client):
+        """Архивировать все накопленные за окно чаты одним запросом"""
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._flush_task = None
+        
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        request = EditPeerFoldersRequest([
+            InputFolderPeer(peer=input_peer, folder_id=1)  # 1 = архивная папка
+            for input_peer in pending.values()
+        ])
+        try:
+            await get_request_executor(client).call(
+                'edit_folder',
+                lambda: client(request, flood_sleep_threshold=0),
+                priority=REQUEST_BACKGROUND
+            )
+            self.archived.update(pending)
+            logger.info(f"Отправлено в архив чатов: {len(pending)}")
+        except Exception as e:
+            logger.error(f"Не удалось архивировать чаты: {e}")
+    
+    def apply_update(self, update):
+        """Учесть изменение настроек уведомлений или папки чата"""
+        if isinstance(update, UpdateNotifySettings):
+            if isinstance(update.peer, NotifyPeer):
+                mute_until = update.notify_settings.mute_until
+                if isinstance(mute_until, datetime):
+                    mute_until = mute_until.timestamp()
+                self.set_muted(
+                    utils.get_peer_id(update.peer.peer),
+                    bool(mute_until and mute_until > time.time())
+                )
+        elif isinstance(update, UpdateFolderPeers):
+            for folder_peer in update.folder_peers:
+                peer_id = utils.get_peer_id(folder_peer.peer)
+                if folder_peer.folder_id == 1:
+                    self.archived.add(peer_id)
+                else:
+                    self.archived.discard(peer_id)
+
+# Состояние чатов для каждого клиента
+dialog_states = weakref.WeakKeyDictionary()
+
+def get_dialog_state(client):
+    """Получить состояние чатов клиента"""
+    state = dialog_states.get(client)
+    if state is None:
+        state = dialog_states[client] = DialogStateTracker()
+    return state
+
+# Ограничение частоты автоответов
+
+# Окно тишины автоответов для одного собеседника в секундах
+AUTO_REPLY_COOLDOWN = float(os.environ.get('AUTO_REPLY_COOLDOWN', '300'))
+
+class ReplyCooldown:
+    """Окно тишины автоответов для пар (аккаунт, чат)"""
+    
+    def __init__(self, window=AUTO_REPLY_COOLDOWN):
+        self.window = window
+        # Окно одинаково для всех, поэтому порядок вставки совпадает с порядком истечения
+        self._expires = OrderedDict()
+        self.allowed = 0
+        self.suppressed = 0
+    
+    def allow(self, account_id, peer_id):
+        """True, если автоответ разрешен; иначе он подавляется до конца окна"""
+        now = time.monotonic()
+        self._purge(now)
+        
+        key = (account_id, peer_id)
+        if key in self._expires:
+            self.suppressed += 1
+            return False
+        
+        self._expires[key] = now + self.window
+        self.allowed += 1
+        return True
+    
+    def _purge(self, now):
+        """Удалить истекшие окна"""
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now:
+                break
+            del self._expires[key]
+    
+    def stats(self):
+        """Количество отправленных и подавленных автоответов"""
+        return {
+            'allowed': self.allowed,
+            'suppressed': self.suppressed,
+            'active': len(self._expires),
+        }
+
+reply_cooldown = ReplyCooldown()
+
+# Данные собственного аккаунта клиента
+
+ClientIdentity = namedtuple('ClientIdentity', ['id', 'username', 'is_premium'])
+
+# Данные аккаунта для каждого клиента (заполняются при подключении)
+client_identities = weakref.WeakKeyDictionary()
+
+def set_client_identity(client, me):
+    """Сохранить данные аккаунта из результата get_me()"""
+    identity = ClientIdentity(
+        id=me.id,
+        username=me.username,
+        is_premium=bool(getattr(me, 'premium', False))
+    )
+    client_identities[client] = identity
+    return identity
+
+def get_client_identity(client):
+    """Получить сохраненные данные аккаунта клиента (None, если неизвестны)"""
+    return client_identities.get(client)
+
+async def refresh_client_identity(client):
+    """Повторно запросить данные аккаунта (после входа или изменения профиля)"""
+    me = await client.get_me()
+    if me is None:
+        client_identities.pop(client, None)
+        return None
+    return set_client_identity(client, me)
+
+# Управление жизненным циклом клиентов
+
+# Отключение клиентов включается явно: отключенный клиент не получает сообщения, пока не будет
+# подключен снова - при обращении пользователя к боту или периодически для получения пропущенного
+# Время простоя, после которого клиент отключается (0 - не отключать)
+CLIENT_IDLE_TIMEOUT = float(os.environ.get('CLIENT_IDLE_TIMEOUT', '0'))
+# Максимальное количество одновременно подключенных клиентов (0 - без ограничения)
+CLIENT_MAX_CONNECTED = int(os.environ.get('CLIENT_MAX_CONNECTED', '0'))
+# Интервал, через который отключенный клиент подключается за пропущенными сообщениями (0 - только по обращению)
+CLIENT_CATCH_UP_INTERVAL = float(os.environ.get('CLIENT_CATCH_UP_INTERVAL', '900'))
+# Максимальное количество одновременных попыток подключения
+CLIENT_CONNECT_CONCURRENCY = int(os.environ.get('CLIENT_CONNECT_CONCURRENCY', '5'))
+# Интервал проверки простаивающих клиентов в секундах
+CLIENT_SWEEP_INTERVAL = float(os.environ.get('CLIENT_SWEEP_INTERVAL', '60'))
+
+def estimate_size(obj, seen=None):
+    """Приблизительный размер объекта в памяти с учетом вложенных коллекций"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(estimate_size(item, seen) for item in obj)
+    return size
+
+class ClientRecord:
+    """Сведения об активности клиента"""
+    
+    def __init__(self, client):
+        self.client = client
+        self.last_activity = time.monotonic()
+        self.idle = False
+        self.suspended_at = None
+
+class ClientManager:
+    """Учет активности клиентов, отключение по простою и корректное завершение"""
+    
+    def __init__(self, idle_timeout=CLIENT_IDLE_TIMEOUT, max_connected=CLIENT_MAX_CONNECTED,
+                 connect_concurrency=CLIENT_CONNECT_CONCURRENCY, sweep_interval=CLIENT_SWEEP_INTERVAL,
+                 catch_up_interval=CLIENT_CATCH_UP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.max_connected = max_connected
+        self.sweep_interval = sweep_interval
+        self.catch_up_interval = catch_up_interval
+        self.connect_concurrency = connect_concurrency
+        self.records = {}
+        self._sweeper = None
+        self._connect_limit = None
+    
+    @property
+    def connect_limit(self):
+        """Семафор одновременных подключений (создается внутри цикла событий)"""
+        if self._connect_limit is None:
+            self._connect_limit = asyncio.Semaphore(self.connect_concurrency)
+        return self._connect_limit
+    
+    def register(self, user_id, client):
+        """Начать учет нового подключенного клиента"""
+        self.records[user_id] = ClientRecord(client)
+        if (self.idle_timeout or self.max_connected) and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+    
+    def touch(self, user_id):
+        """Отметить активность клиента"""
+        record = self.records.get(user_id)
+        if record is not None:
+            record.last_activity = time.monotonic()
+    
+    def is_idle(self, user_id):
+        """Проверить, отключен ли клиент по простою"""
+        record = self.records.get(user_id)
+        return record is not None and record.idle
+    
+    async def reconnect(self, user_id, touch=True):
+        """Повторно подключить клиент, отключенный по простою, и получить пропущенные обновления"""
+        record = self.records[user_id]
+        async with self.connect_limit:
+            await record.client.connect()
+        # Сообщения, пришедшие за время отключения, обрабатываются подключенными обработчиками
+        await record.client.catch_up()
+        record.idle = False
+        record.suspended_at = None
+        if touch:
+            record.last_activity = time.monotonic()
+        logger.info(f"Клиент пользователя {user_id} повторно подключен после простоя")
+    
+    async def resume(self, user_id):
+        """Подключить клиент, отключенный по простою, при обращении пользователя к боту"""
+        if not self.is_idle(user_id):
+            self.touch(user_id)
+            return
+        try:
+            await self.reconnect(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка при подключении клиента пользователя {user_id}: {e}")
+    
+    async def suspend(self, user_id):
+        """Отключить клиент, сохранив сессию и подключенные обработчики"""
+        record = self.records[user_id]
+        await record.client.disconnect()
+        record.idle = True
+        record.suspended_at = time.monotonic()
+        # Кэш сущностей будет заполнен заново после подключения
+        entity_caches.pop(record.client, None)
+        logger.info(f"Клиент пользователя {user_id} отключен по простою")
+    
+    async def sweep(self):
+        """Отключить простаивающие клиенты и клиенты сверх лимита подключений"""
+        now = time.monotonic()
+        connected = sorted(
+            (record.last_activity, user_id)
+            for user_id, record in self.records.items() if not record.idle
+        )
+        
+        excess = len(connected) - self.max_connected if self.max_connected else 0
+        for last_activity, user_id in connected:
+            if excess > 0 or (self.idle_timeout and now - last_activity > self.idle_timeout):
+                try:
+                    await self.suspend(user_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при отключении клиента пользователя {user_id}: {e}")
+                excess -= 1
+        
+        if self.catch_up_interval:
+            await self.catch_up(now)
+    
+    async def catch_up(self, now):
+        """Подключить давно отключенные клиенты, чтобы получить пропущенные сообщения"""
+        # Время активности не обновляется: без новых сообщений клиент отключится при следующей проверке
+        for user_id, record in list(self.records.items()):
+            if record.idle and now - record.suspended_at >= self.catch_up_interval:
+                try:
+                    await self.reconnect(user_id, touch=False)
+                except Exception as e:
+                    logger.error(f"Ошибка при подключении клиента пользователя {user_id}: {e}")
+    
+    async def _sweep_loop(self):
+        """Периодическая проверка простаивающих клиентов"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.sweep()
+    
+    def stats(self):
+        """Сведения о клиентах: состояние, время простоя и оценка занимаемой памяти"""
+        now = time.monotonic()
+        return {
+            user_id: {
+                'connected': not record.idle and record.client.is_connected(),
+                'suspended': record.idle,
+                'idle_seconds': now - record.last_activity,
+                'memory': estimate_size([
+                    getattr(entity_caches.get(record.client), '_entries', None),
+                    getattr(dialog_states.get(record.client), 'muted', None),
+                    getattr(dialog_states.get(record.client), 'archived', None),
+                    getattr(getattr(record.client, '_mb_entity_cache', None), 'hash_map', None),
+                ]),
+            }
+            for user_id, record in self.records.items()
+        }
+    
+    async def shutdown(self):
+        """Отключить все клиенты параллельно и сохранить их сессии"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        
+        async def close(user_id, client):
+            try:
+                # disconnect() сохраняет и закрывает сессию
+                await client.disconnect()
+            except Exception as e:
+                logger.error(f"Ошибка при отключении клиента пользователя {user_id}: {e}")
+        
+        await asyncio.gather(*(close(user_id, client) for user_id, client in active_clients.items()))
+        logger.info(f"Отключено клиентов: {len(active_clients)}")
+
+client_manager = ClientManager()
+
+async def shutdown_clients(application=None):
+    """Корректное завершение: отправка уведомлений, отключение клиентов и сохранение данных"""
+    # Сигнатура совместима с Application.builder().post_shutdown()
+    global metrics_exporter_task
+    await asyncio.gather(*(
+        asyncio.wait_for(dispatcher.join(), timeout=5)
+        for dispatcher in list(event_dispatchers.values())
+    ), return_exceptions=True)
+    for task in list(media_transfers):
+        task.cancel()
+    await notification_scheduler.flush(timeout=5)
+    
+    # Остановка фоновых задач, чтобы цикл событий закрылся без незавершенных задач
+    stopped = list(media_transfers)
+    for executor in list(request_executors.values()):
+        stopped.extend(executor.close())
+    for dispatcher in list(event_dispatchers.values()):
+        stopped.extend(dispatcher.close())
+    await client_manager.shutdown()
+    stopped.extend(notification_scheduler.close())
+    if metrics_exporter_task is not None:
+        metrics_exporter_task.cancel()
+        stopped.append(metrics_exporter_task)
+        metrics_exporter_task = None
+    await asyncio.gather(*stopped, return_exceptions=True)
+    
+    config_storage.flush()
+    if message_index is not None:
+        message_index.flush()
+    # Ненаправленные сводки остаются в файлах и отправляются после перезапуска
+    close_digest_spools()
+
+# Диспетчер событий: параллельно по чатам, по порядку внутри чата
+
+# Количество одновременно обрабатываемых чатов для одного клиента
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', '8'))
+# Максимальное количество событий в очереди клиента (при заполнении прием событий ждет)
+EVENT_QUEUE_LIMIT = int(os.environ.get('EVENT_QUEUE_LIMIT', '1000'))
+
+class ChatOrderedDispatcher:
+    """Пул обработчиков, сохраняющий порядок событий внутри каждого чата"""
+    
+    def __init__(self, workers=EVENT_WORKERS, queue_limit=EVENT_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._chats = {}
+        self._ready = None
+        self._slots = None
+        self._idle = None
+        self._tasks = []
+        self.pending = 0
+        self.processed = 0
+        self.backpressure_waits = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+    
+    def _start(self):
+        """Создать очередь и обработчики (внутри работающего цикла событий)"""
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.queue_limit)
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def submit(self, key, handler, event):
+        """Поставить событие в очередь чата; ждет, если очередь клиента заполнена"""
+        self._start()
+        if self._slots.locked():
+            self.backpressure_waits += 1
+        await self._slots.acquire()
+        
+        self.pending += 1
+        self._idle.clear()
+        item = (handler, event, time.perf_counter())
+        queue = self._chats.get(key)
+        if queue is None:
+            self._chats[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в работе или в очереди - событие будет обработано после предыдущих
+            queue.append(item)
+    
+    async def _worker(self):
+        """Обработка событий: одно событие чата за раз, затем чат уходит в конец очереди"""
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            handler, event, submitted = queue[0]
+            try:
+                await handler(event)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике события чата {key}: {e}")
+            finally:
+                queue.popleft()
+                self.pending -= 1
+                self.processed += 1
+                self.latencies.append(time.perf_counter() - submitted)
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                if not self.pending:
+                    self._idle.set()
+    
+    async def join(self):
+        """Дождаться обработки всех поставленных событий"""
+        if self._idle is not None:
+            await self._idle.wait()
+    
+    def close(self):
+        """Остановить обработчики (необработанные события отбрасываются); возвращает отмененные задачи"""
+        tasks = self._tasks
+        for task in tasks:
+            task.cancel()
+        self._tasks = []
+        self._chats.clear()
+        self._ready = self._slots = self._idle = None
+        self.pending = 0
+        return tasks
+    
+    def stats(self):
+        """Глубина очереди и задержка событий от поступления до завершения обработки"""
+        latencies = sorted(self.latencies)
+        return {
+            'pending': self.pending,
+            'chats': len(self._chats),
+            'processed': self.processed,
+            'backpressure_waits': self.backpressure_waits,
+            'latency_p50': latencies[int(len(latencies) * 0.5)] if latencies else 0.0,
+            'latency_p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0,
+        }
+
+# Диспетчеры событий для каждого клиента
+event_dispatchers = weakref.WeakKeyDictionary()
+
+def get_event_dispatcher(client):
+    """Получить диспетчер событий клиента"""
+    dispatcher = event_dispatchers.get(client)
+    if dispatcher is None:
+        dispatcher = event_dispatchers[client] = ChatOrderedDispatcher()
+    return dispatcher
+
+def dispatch_by_chat(dispatcher, handler):
+    """Обертка обработчика Telethon, передающая событие в очередь его чата"""
+    async def dispatch(event):
+        await dispatcher.submit(event.chat_id, handler, event)
+    return dispatch
+
+# Исполнитель запросов MTProto
+
+# Приоритеты запросов (меньше - важнее)
+REQUEST_URGENT, REQUEST_NORMAL, REQUEST_BACKGROUND = range(3)
+
+# Количество одновременно выполняемых запросов одного клиента
+REQUEST_CONCURRENCY = int(os.environ.get('REQUEST_CONCURRENCY', '4'))
+# Максимальное ожидание FloodWait, после которого запрос завершается ошибкой, в секундах
+REQUEST_MAX_FLOOD_WAIT = float(os.environ.get('REQUEST_MAX_FLOOD_WAIT', '600'))
+
+class RequestExecutor:
+    """Очередь запросов клиента с приоритетами, отложенным повтором при FloodWait и метриками"""
+    
+    def __init__(self, concurrency=REQUEST_CONCURRENCY, max_flood_wait=REQUEST_MAX_FLOOD_WAIT):
+        self.concurrency = concurrency
+        self.max_flood_wait = max_flood_wait
+        self._heap = []
+        self._queued = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._workers = []
+        self._deferred = {}
+        self.deduplicated = 0
+        self.flood_waits = 0
+    
+    def submit(self, method, factory, priority=REQUEST_NORMAL, key=None):
+        """Поставить запрос в очередь; factory создает корутину запроса при каждой попытке"""
+        # Запрос с тем же ключом, еще ожидающий в очереди, не дублируется
+        if key is not None and key in self._queued:
+            self.deduplicated += 1
+            return self._queued[key]
+        
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._queued[key] = future
+        self._push((priority, next(self._seq), method, factory, key, future))
+        return future
+    
+    async def call(self, method, factory, priority=REQUEST_NORMAL, key=None):
+        """Выполнить запрос через очередь и дождаться результата"""
+        return await asyncio.shield(self.submit(method, factory, priority, key))
+    
+    def _push(self, item):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        heapq.heappush(self._heap, item)
+        self._wakeup.set()
+    
+    def _retry(self, item):
+        """Вернуть в очередь запрос, отложенный по FloodWait"""
+        del self._deferred[item[1]]
+        self._push(item)
+    
+    async def _worker(self):
+        """Выполнение запросов в порядке приоритета"""
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            
+            item = heapq.heappop(self._heap)
+            priority, _, method, factory, key, future = item
+            if key is not None and self._queued.get(key) is future:
+                del self._queued[key]
+            if future.done():
+                continue
+            
+            started = time.perf_counter()
+            try:
+                result = await factory()
+            except FloodWaitError as e:
+                pipeline_metrics.observe('mtproto', method, time.perf_counter() - started, False)
+                if e.seconds > self.max_flood_wait:
+                    future.set_exception(e)
+                    continue
+                # Запрос повторяется после ожидания, остальные запросы продолжают выполняться
+                self.flood_waits += 1
+                logger.warning(f"FloodWait {e.seconds} с для {method}, запрос отложен")
+                if key is not None:
+                    self._queued.setdefault(key, future)
+                handle = asyncio.get_running_loop().call_later(e.seconds, self._retry, item)
+                self._deferred[item[1]] = (handle, item)
+            except Exception as e:
+                pipeline_metrics.observe('mtproto', method, time.perf_counter() - started, False)
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                pipeline_metrics.observe('mtproto', method, time.perf_counter() - started, True)
+                if not future.done():
+                    future.set_result(result)
+    
+    def close(self):
+        """Остановить выполнение запросов; возвращает отмененные задачи"""
+        tasks = self._workers
+        for task in tasks:
+            task.cancel()
+        for item in self._heap:
+            item[-1].cancel()
+        # Таймеры повторов отменяются, иначе они снова запустили бы обработчики после остановки
+        for handle, item in self._deferred.values():
+            handle.cancel()
+            item[-1].cancel()
+        self._deferred.clear()
+        self._heap.clear()
+        self._queued.clear()
+        self._workers = []
+        self._wakeup = None
+        return tasks
+    
+    def stats(self):
+        """Глубина очереди, количество отброшенных дубликатов и отложенных по FloodWait запросов"""
+        return {
+            'queued': len(self._heap),
+            'deferred': len(self._deferred),
+            'deduplicated': self.deduplicated,
+            'flood_waits': self.flood_waits,
+        }
+
+# Исполнители запросов для каждого клиента
+request_executors = weakref.WeakKeyDictionary()
+
+def get_request_executor(client):
+    """Получить исполнитель запросов клиента"""
+    executor = request_executors.get(client)
+    if executor is None:
+        executor = request_executors[client] = RequestExecutor()
+    return executor
+
+# Покинутые каналы
+
+class LeftChannels:
+    """Каналы, из которых вышел пользователь, и выполняющиеся запросы выхода"""
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.left = set(read_user_config(user_id).get('left_channels', []))
+        self._inflight = {}
+    
+    def has_left(self, channel_id):
+        """Проверить, вышел ли пользователь из канала"""
+        return channel_id in self.left
+    
+    def forget(self, channel_id):
+        """Снять отметку о выходе (например, после повторного добавления)"""
+        if channel_id in self.left:
+            self.left.discard(channel_id)
+            self._save()
+    
+    async def leave(self, client, channel_id):
+        """Выйти из канала; возвращает (успех, начат ли выход этим вызовом)"""
+        # Одновременные вызовы для одного канала ждут один общий запрос
+        task = self._inflight.get(channel_id)
+        if task is not None:
+            return await asyncio.shield(task), False
+        
+        task = self._inflight[channel_id] = asyncio.ensure_future(leave_channel(client, channel_id))
+        try:
+            left = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(channel_id, None)
+        
+        if left:
+            self.left.add(channel_id)
+            self._save()
+        return left, True
+    
+    def _save(self):
+        update_user_config(self.user_id, left_channels=sorted(self.left))
+
+# Покинутые каналы по ID пользователя
+left_channels_registry = {}
+
+def get_left_channels(user_id):
+    """Получить покинутые каналы пользователя"""
+    registry = left_channels_registry.get(user_id)
+    if registry is None:
+        registry = left_channels_registry[user_id] = LeftChannels(user_id)
+    return registry
+
+# Правила обработки входящих сообщений
+
+# Допустимые действия правил
+RULE_ACTIONS = ('reply', 'forward', 'digest', 'mute', 'archive', 'block', 'ignore')
+# Типы отправителей, по которым можно фильтровать сообщения
+RULE_SENDER_TYPES = ('user', 'bot', 'group', 'channel')
+# Максимальное количество правил одного пользователя
+MAX_USER_RULES = int(os.environ.get('MAX_USER_RULES', '500'))
+# Максимальная длина одного регулярного выражения
+RULE_REGEX_MAX_LENGTH = int(os.environ.get('RULE_REGEX_MAX_LENGTH', '200'))
+# Длина начала текста, проверяемого регулярными выражениями
+RULE_REGEX_TEXT_LIMIT = int(os.environ.get('RULE_REGEX_TEXT_LIMIT', '4096'))
+# Текст автоответа, если в правиле он не указан
+DEFAULT_REPLY_TEXT = "Ваше сообщение получено."
+
+# Скомпилированное правило: порядковый номер, действия и текст автоответа
+CompiledRule = namedtuple('CompiledRule', ['index', 'actions', 'text'])
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик: поиск всех ключевых слов за один проход по тексту"""
+    
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        # Для каждого состояния - битовая маска правил, ключевые слова которых в нем заканчиваются
+        self._output = [0]
+    
+    def add(self, keyword, mask):
+        """Добавить ключевое слово с маской правил"""
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(0)
+            state = next_state
+        self._output[state] |= mask
+    
+    def build(self):
+        """Построить переходы по неудаче (после добавления всех слов)"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
+    
+    def search(self, text):
+        """Маска правил, ключевые слова которых встречаются в тексте"""
+        found = 0
+        state = 0
+        goto = self._goto
+        for char in text:
+            while state and char not in goto[state]:
+                state = self._fail[state]
+            state = goto[state].get(char, 0)
+            found |= self._output[state]
+        return found
+
+def as_list(value):
+    """Привести значение поля правила к списку"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def get_regex_options():
+    """Параметры RE2 для правил: без учета регистра"""
+    options = re2.Options()
+    options.case_sensitive = False
+    # Ошибки синтаксиса сообщаются пользователю, а не в журнал
+    options.log_errors = False
+    return options
+
+def compile_rule_regex(patterns):
+    """Проверить регулярные выражения правила и объединить их в одно выражение RE2"""
+    if not patterns:
+        return None
+    if re2 is None:
+        raise ValueError("Регулярные выражения в правилах требуют пакета google-re2")
+    
+    for pattern in patterns:
+        if len(pattern) > RULE_REGEX_MAX_LENGTH:
+            raise ValueError(f"Регулярное выражение длиннее {RULE_REGEX_MAX_LENGTH} символов")
+    
+    # RE2 не поддерживает обратные ссылки и просмотр вперед, зато не допускает экспоненциального перебора
+    pattern = '|'.join(f'(?:{pattern})' for pattern in patterns)
+    try:
+        re2.compile(pattern, get_regex_options())
+    except re2.error as e:
+        reason = e.args[0] if e.args else e
+        if isinstance(reason, bytes):
+            reason = reason.decode('utf-8', 'replace')
+        raise ValueError(f"Некорректное регулярное выражение: {reason}")
+    return pattern
+
+class CompiledRules:
+    """Набор правил, скомпилированный в битовые маски, автомат ключевых слов и регулярные выражения"""
+    
+    def __init__(self, rules):
+        if not isinstance(rules, list):
+            raise ValueError("Правила должны быть списком")
+        if len(rules) > MAX_USER_RULES:
+            raise ValueError(f"Слишком много правил (максимум {MAX_USER_RULES})")
+        
+        self.rules = []
+        self._sender_masks = dict.fromkeys(RULE_SENDER_TYPES, 0)
+        self._allowed = {}
+        self._unrestricted = 0
+        self._denied = {}
+        self._keywords = KeywordAutomaton()
+        self._without_keywords = 0
+        # Выражения всех правил в одном наборе RE2: один проход по тексту независимо от числа правил
+        self._regex_set = None
+        self._regex_masks = []
+        self._without_regex = 0
+        
+        for index, spec in enumerate(rules):
+            self.rules.append(self._add(index, spec))
+        self._keywords.build()
+        if self._regex_set is not None:
+            self._regex_set.Compile()
+    
+    def _add(self, index, spec):
+        """Проверить правило и добавить его условия в индексы"""
+        if not isinstance(spec, dict):
+            raise ValueError(f"Правило {index + 1}: ожидается объект")
+        mask = 1 << index
+        
+        actions = tuple(as_list(spec.get('actions', spec.get('action'))))
+        if not actions or any(action not in RULE_ACTIONS for action in actions):
+            raise ValueError(f"Правило {index + 1}: действие должно быть одним из {', '.join(RULE_ACTIONS)}")
+        
+        senders = as_list(spec.get('sender')) or ['any']
+        if 'any' in senders:
+            senders = RULE_SENDER_TYPES
+        for sender_type in senders:
+            if sender_type not in self._sender_masks:
+                raise ValueError(f"Правило {index + 1}: неизвестный тип отправителя {sender_type}")
+            self._sender_masks[sender_type] |= mask
+        
+        try:
+            allowed = [int(chat_id) for chat_id in as_list(spec.get('chats'))]
+            denied = [int(chat_id) for chat_id in as_list(spec.get('exclude_chats'))]
+        except (TypeError, ValueError):
+            raise ValueError(f"Правило {index + 1}: ID чатов должны быть числами")
+        if allowed:
+            for chat_id in allowed:
+                self._allowed[chat_id] = self._allowed.get(chat_id, 0) | mask
+        else:
+            self._unrestricted |= mask
+        for chat_id in denied:
+            self._denied[chat_id] = self._denied.get(chat_id, 0) | mask
+        
+        keywords = [str(keyword).casefold() for keyword in as_list(spec.get('keywords')) if str(keyword)]
+        if keywords:
+            for keyword in keywords:
+                self._keywords.add(keyword, mask)
+        else:
+            self._without_keywords |= mask
+        
+        try:
+            regex = compile_rule_regex([str(pattern) for pattern in as_list(spec.get('regex'))])
+        except ValueError as e:
+            raise ValueError(f"Правило {index + 1}: {e}")
+        if regex is None:
+            self._without_regex |= mask
+        else:
+            if self._regex_set is None:
+                self._regex_set = re2.Set.SearchSet(get_regex_options())
+            self._regex_set.Add(regex)
+            self._regex_masks.append(mask)
+        
+        text = spec.get('text')
+        return CompiledRule(index, actions, str(text) if text else DEFAULT_REPLY_TEXT)
+    
+    def match(self, sender_type, chat_id, text):
+        """Подходящие правила в порядке их следования"""
+        candidates = self._sender_masks.get(sender_type, 0)
+        candidates &= self._unrestricted | self._allowed.get(chat_id, 0)
+        candidates &= ~self._denied.get(chat_id, 0)
+        
+        # Поиск ключевых слов нужен, только если остались правила с ними
+        if candidates & ~self._without_keywords:
+            candidates &= self._without_keywords | self._keywords.search(text.casefold())
+        
+        # Набор RE2 проверяется, только если остались правила с регулярными выражениями
+        if candidates & ~self._without_regex:
+            matched = self._without_regex
+            for regex_index in self._regex_set.Match(text[:RULE_REGEX_TEXT_LIMIT]) or ():
+                matched |= self._regex_masks[regex_index]
+            candidates &= matched
+        
+        while candidates:
+            lowest = candidates & -candidates
+            candidates ^= lowest
+            yield self.rules[lowest.bit_length() - 1]
+
+# Поведение режимов, выраженное теми же правилами (применяется после правил пользователя)
+MODE_RULES = {
+    1: CompiledRules([
+        {'actions': ['reply'], 'text': "Ваше сообщение получено. Отвечу позже."},
+    ]),
+    2: CompiledRules([
+        {'sender': 'bot', 'actions': ['block']},
+        {'actions': ['mute', 'archive', 'reply', 'forward'], 'text': DEFAULT_REPLY_TEXT},
+    ]),
+    3: CompiledRules([
+        {'sender': 'bot', 'actions': ['block']},
+        {'actions': ['mute', 'archive', 'reply', 'digest'], 'text': DEFAULT_REPLY_TEXT},
+    ]),
+}
+
+# Скомпилированные правила по ID пользователя (правила меняются только через save_user_rules)
+compiled_user_rules = {}
+
+def get_user_rules(user_id):
+    """Получить скомпилированные правила пользователя (из конфигурации - при первом обращении)"""
+    compiled = compiled_user_rules.get(user_id)
+    if compiled is not None:
+        return compiled
+    
+    try:
+        compiled = CompiledRules(read_user_config(user_id).get('rules') or [])
+    except ValueError as e:
+        logger.error(f"Некорректные правила пользователя {user_id}: {e}")
+        compiled = CompiledRules([])
+    compiled_user_rules[user_id] = compiled
+    return compiled
+
+def save_user_rules(user_id, rules):
+    """Проверить, скомпилировать и сохранить правила пользователя"""
+    compiled = CompiledRules(rules)
+    update_user_config(user_id, rules=rules)
+    compiled_user_rules[user_id] = compiled
+    return compiled
+
+def get_sender_type(event, sender):
+    """Тип отправителя сообщения для правил"""
+    if sender.is_bot:
+        return 'bot'
+    if event.is_group:
+        return 'group'
+    if event.is_channel:
+        return 'channel'
+    return 'user'
+
+def match_rules(user_id, mode, event, sender):
+    """Подходящие правила: сначала пользовательские, затем правила режима"""
+    text = getattr(event.message, 'message', None) or ''
+    sender_type = get_sender_type(event, sender)
+    yield from get_user_rules(user_id).match(sender_type, event.chat_id, text)
+    yield from MODE_RULES.get(mode, MODE_RULES[1]).match(sender_type, event.chat_id, text)
+
+# Функции для работы с Telethon клиентом
+
+async def init_telethon_client(user_id, phone=None):
+    """Инициализировать Telethon клиент для пользователя"""
+    session_path = get_session_path(user_id)
+    
+    # Проверка, существует ли клиент и подключен ли он
+    if user_id in active_clients and active_clients[user_id].is_connected():
+        logger.info(f"Используется существующий клиент для пользователя {user_id}")
+        client_manager.touch(user_id)
+        return active_clients[user_id]
+    
+    # Клиент, отключенный по простою, подключается заново с сохранением обработчиков
+    if client_manager.is_idle(user_id):
+        await client_manager.reconnect(user_id)
+        return active_clients[user_id]
+    
+    logger.info(f"Создание нового клиента для пользователя {user_id}")
+    
+    # Создание нового клиента с более надежными настройками
+    client = TelegramClient(
+        session_path, 
+        API_ID, 
+        API_HASH,
+        connection_retries=10,           # Более активные повторные попытки соединения
+        auto_reconnect=True,             # Автоматическое переподключение
+        retry_delay=1,                   # Задержка между повторными попытками в секундах
+        request_retries=10,              # Повторные попытки для запросов API
+        sequential_updates=True          # Прием обновлений по порядку; обработка - в диспетчере событий
+    )
+    
+    # Важно: Для загрузки сохраненных настроек устройства
+    client.session.set_dc(2, '149.154.167.51', 443)
+    
+    # Подключение с логикой повторных попыток (число одновременных подключений ограничено)
+    async with client_manager.connect_limit:
+        for attempt in range(3):
+            try:
+                await client.connect()
+                if await client.is_user_authorized():
+                    logger.info(f"Пользователь {user_id} авторизован с сохраненной сессией")
+                    
+                    # Проверка сессии
+                    me = await client.get_me()
+                    if me:
+                        set_client_identity(client, me)
+                        logger.info(f"Сессия подтверждена для пользователя {me.first_name} (ID: {me.id})")
+                    else:
+                        logger.warning("Не удалось получить информацию о пользователе, хотя сессия активна")
+                break
+            except Exception as e:
+                logger.error(f"Ошибка при подключении клиента (попытка {attempt+1}/3): {e}")
+                if attempt == 2:  # Последняя попытка не удалась
+                    raise
+    
+    # Сохранение клиента в словаре
+    active_clients[user_id] = client
+    client_manager.register(user_id, client)
+    
+    return client
+
+# Обработчики, подключенные к каждому клиенту
+client_handlers = weakref.WeakKeyDictionary()
+
+def attach_event_handlers(client, handlers):
+    """Подключить обработчики к клиенту, заменив ранее подключенные"""
+    detach_event_handlers(client)
+    for callback, event in handlers:
+        client.add_event_handler(callback, event)
+    client_handlers[client] = list(handlers)
+
+def detach_event_handlers(client):
+    """Отключить все обработчики, подключенные к клиенту"""
+    for callback, event in client_handlers.pop(client, []):
+        client.remove_event_handler(callback, event)
+
+async def login_with_code(client, phone, code):
+    """Вход с использованием предоставленного кода подтверждения"""
+    try:
+        # Специальный флаг для авторизации без вытеснения других сессий
+        # Учитывая, что стандартного решения нет, можно экспериментально попробовать
+        # следующие параметры:
+        
+        # 1. Вход со специальными параметрами
+        await client.sign_in(
+            phone=phone, 
+            code=code,
+            # Пытаемся указать, что хотим сохранить существующие сессии 
+            settings=None,  
+            # Не отключать другие устройства
+            sign_up=False
+        )
+        
+        # Проверка, что успешно вошли
+        if await client.is_user_authorized():
+            logger.info(f"Успешный вход с номера {phone} с сохранением других сессий")
+            await refresh_client_identity(client)
+            return True
+        else:
+            logger.error(f"Не удалось авторизоваться с номера {phone} после sign_in")
+            return False
+    except Exception as e:
+        logger.error(f"Ошибка при входе через код подтверждения: {e}")
+        raise
+
+async def setup_telethon_event_handlers(client, telegram_chat_id, context):
+    """Настройка обработчиков событий для Telethon клиента"""
+    
+    start_metrics_exporter()
+    
+    # Обработчики используют сохраненные данные аккаунта без сетевых запросов
+    if get_client_identity(client) is None:
+        await refresh_client_identity(client)
+    
+    async def block_sender(event, sender, mode, user_id):
+        """Заблокировать отправителя (ботов, которым пользователь отправлял /start, не трогает)"""
+        if sender.is_bot:
+            # Проверка по индексу запущенных ботов
+            with pipeline_metrics.stage(mode, 'bot_check'):
+                found_start_message = await has_started_bot(client, user_id, sender)
+            if found_start_message:
+                return False
+        
+        try:
+            with pipeline_metrics.stage(mode, 'block'):
+                await get_request_executor(client).call(
+                    'BlockRequest',
+                    lambda: client(BlockRequest(sender.input_peer), flood_sleep_threshold=0),
+                    priority=REQUEST_URGENT,
+                    key=('block', sender.peer_id)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при блокировке отправителя: {e}")
+            notify(
+                context.bot,
+                telegram_chat_id,
+                f"Не удалось заблокировать {'бота' if sender.is_bot else 'пользователя'} {sender.name}: {str(e)}",
+                priority=NOTIFY_ERROR
+            )
+            return False
+        
+        notify(
+            context.bot,
+            telegram_chat_id,
+            f"Заблокирован бот: {sender.name} (не найдено сообщение /start)" if sender.is_bot
+            else f"Заблокирован пользователь: {sender.name}",
+            priority=NOTIFY_STATUS
+        )
+        return True
+    
+    def reply_done(mode, sender_name, delivers_content, started, future):
+        """Обработать завершение фонового автоответа"""
+        ok = not future.cancelled() and future.exception() is None
+        pipeline_metrics.observe(mode, 'reply', time.perf_counter() - started, ok)
+        if future.cancelled():
+            return
+        if not ok:
+            logger.error(f"Ошибка при отправке автоответа: {future.exception()}")
+            notify(
+                context.bot,
+                telegram_chat_id,
+                f"Ошибка при обработке сообщения от {sender_name}: {str(future.exception())}",
+                priority=NOTIFY_ERROR
+            )
+        elif not delivers_content:
+            notify(
+                context.bot,
+                telegram_chat_id,
+                f"Получено сообщение от {sender_name}. Автоматически отправлен ответ с подтверждением.",
+                priority=NOTIFY_STATUS
+            )
+    
+    async def apply_rule(rule, event, sender, mode, user_id):
+        """Выполнить действия правила; False - сообщение передается следующему правилу"""
+        executor = get_request_executor(client)
+        sender_name = sender.name
+        actions = rule.actions
+        # Содержимое пересылается или попадает в сводку - отдельное уведомление об автоответе не нужно
+        delivers_content = 'forward' in actions or 'digest' in actions
+        
+        if 'ignore' in actions:
+            return True
+        
+        if 'block' in actions:
+            if await block_sender(event, sender, mode, user_id):
+                return True
+            if len(actions) == 1:
+                return False
+        
+        # Отключение уведомлений и архивирование чата
+        if 'mute' in actions or 'archive' in actions:
+            try:
+                chat = await resolve_chat(client, event)
+                dialog_state = get_dialog_state(client)
+                
+                if 'mute' in actions and dialog_state.begin_mute(chat.peer_id):
+                    # Запрос выполняется в фоне с низким приоритетом и не задерживает ответ
+                    request = UpdateNotifySettingsRequest(
+                        peer=InputNotifyPeer(peer=chat.input_peer),
+                        settings=InputPeerNotifySettings(
+                            show_previews=False,
+                            silent=True,
+                            mute_until=2147483647  # Очень далеко в будущем
+                        )
+                    )
+                    future = executor.submit(
+                        'UpdateNotifySettingsRequest',
+                        lambda: client(request, flood_sleep_threshold=0),
+                        priority=REQUEST_BACKGROUND,
+                        key=('mute', chat.peer_id)
+                    )
+                    future.add_done_callback(
+                        functools.partial(dialog_state.mute_done, chat.peer_id, sender_name)
+                    )
+                
+                # Архивирование выполняется пакетами через EditPeerFoldersRequest
+                if 'archive' in actions:
+                    dialog_state.archive(client, chat.peer_id, chat.input_peer)
+            except Exception as e:
+                logger.error(f"Ошибка при отключении уведомлений: {e}")
+        
+        # Автоответ только на первое сообщение в окне тишины
+        if 'reply' in actions:
+            try:
+                if reply_cooldown.allow(user_id, event.chat_id):
+                    reply_request = SendMessageRequest(
+                        peer=await event.get_input_chat(),
+                        message=rule.text,
+                        reply_to=InputReplyToMessage(reply_to_msg_id=event.message.id)
+                    )
+                    # Ответ не ожидается: отложенный по FloodWait запрос не занимает обработчик событий
+                    future = executor.submit(
+                        'reply',
+                        lambda: client(reply_request, flood_sleep_threshold=0),
+                        priority=REQUEST_URGENT
+                    )
+                    future.add_done_callback(functools.partial(
+                        reply_done, mode, sender_name, delivers_content, time.perf_counter()
+                    ))
+                elif not delivers_content:
+                    notify(
+                        context.bot,
+                        telegram_chat_id,
+                        f"Получено сообщение от {sender_name}.",
+                        priority=NOTIFY_STATUS
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка при отправке автоответа: {e}")
+                notify(
+                    context.bot,
+                    telegram_chat_id,
+                    f"Ошибка при обработке сообщения от {sender_name}: {str(e)}",
+                    priority=NOTIFY_ERROR
+                )
+        
+        # Пересылка содержимого сообщения (медиафайлы - вместе с подписью)
+        if 'forward' in actions:
+            try:
+                message_text = parse_message_content(event.message)
+                index_message(telegram_chat_id, sender_name, message_text, event.message)
+                if get_media_kind(event.message) is None:
+                    notify(
+                        context.bot,
+                        telegram_chat_id,
+                        f"Сообщение от {sender_name}:\n\n{message_text}",
+                        priority=NOTIFY_CONTENT
+                    )
+                else:
+                    # Загрузка и отправка идут в фоне и не занимают обработчик событий
+                    forward_media(
+                        client,
+                        context.bot,
+                        telegram_chat_id,
+                        event.message,
+                        f"Сообщение от {sender_name}:\n\n{message_text}",
+                        mode
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка при пересылке сообщения: {e}")
+                notify(
+                    context.bot,
+                    telegram_chat_id,
+                    f"Ошибка при пересылке сообщения от {sender_name}: {str(e)}",
+                    priority=NOTIFY_ERROR
+                )
+        
+        # Накопление сообщения для периодической сводки
+        if 'digest' in actions:
+            try:
+                message_text = parse_message_content(event.message)
+                index_message(telegram_chat_id, sender_name, message_text, event.message)
+                add_to_digest(context.bot, telegram_chat_id, sender_name, message_text)
+            except Exception as e:
+                logger.error(f"Ошибка при добавлении сообщения в сводку: {e}")
+        
+        return True
+    
+    async def handle_new_message(event):
+        """Обработка входящих сообщений по правилам пользователя и выбранного режима"""
+        # Пропуск исходящих сообщений
+        if event.out:
+            return
+        
+        # Получение режима пользователя
+        user_id = context.user_data.get('user_id', telegram_chat_id)
+        client_manager.touch(user_id)
+        
+        # Запоздавшие сообщения из покинутых каналов отбрасываются без запросов к API
+        if event.is_channel and get_left_channels(user_id).has_left(event.chat_id):
+            return
+        
+        mode = get_user_mode(user_id)
+        started = time.perf_counter()
+        ok = True
+        
+        try:
+            # Получение информации об отправителе (через кэш сущностей)
+            with pipeline_metrics.stage(mode, 'resolve'):
+                sender = await resolve_sender(client, event)
+            sender_name = sender.name
+            
+            if event.is_channel:
+                # Выход из канала в обоих режимах (один запрос на канал)
+                leave_started = time.perf_counter()
+                left, initiated = await get_left_channels(user_id).leave(client, event.chat_id)
+                pipeline_metrics.observe(mode, 'leave_channel', time.perf_counter() - leave_started, left)
+                
+                # Уведомление отправляет только событие, начавшее выход
+                if initiated and left:
+                    notify(
+                        context.bot,
+                        telegram_chat_id,
+                        f"Автоматический выход из канала: {sender_name}",
+                        priority=NOTIFY_STATUS
+                    )
+                elif initiated:
+                    notify(
+                        context.bot,
+                        telegram_chat_id,
+                        f"Не удалось выйти из канала {sender_name}",
+                        priority=NOTIFY_ERROR
+                    )
+            else:
+                # Действия первого подходящего правила (несостоявшаяся блокировка передает ход следующему)
+                with pipeline_metrics.stage(mode, 'rules'):
+                    rules = match_rules(user_id, mode, event, sender)
+                    rule = next(rules, None)
+                while rule is not None and not await apply_rule(rule, event, sender, mode, user_id):
+                    rule = next(rules, None)
+        
+        except Exception as e:
+            ok = False
+            logger.error(f"Общая ошибка в обработчике событий: {e}")
+            notify(
+                context.bot,
+                telegram_chat_id,
+                f"Ошибка обработки входящего сообщения: {str(e)}",
+                priority=NOTIFY_ERROR
+            )
+        finally:
+            pipeline_metrics.observe(mode, 'total', time.perf_counter() - started, ok)
+    
+    async def handle_outgoing_start(event):
+        """Запись ботов, которым пользователь отправил /start"""
+        if event.is_private:
+            user_id = context.user_data.get('user_id', telegram_chat_id)
+            get_started_bots_index(user_id).add(event.chat_id)
+    
+    async def handle_chat_action(event):
+        """Обработка действий в чате, например, добавление в группу/канал"""
+        identity = get_client_identity(client)
+        if event.user_added and identity and identity.id in (event.user_ids or ()):
+            # Пользователь был добавлен в группу/канал, выходим из нее
+            left_channels = get_left_channels(context.user_data.get('user_id', telegram_chat_id))
+            # Повторное добавление: прежняя отметка о выходе больше не действует
+            left_channels.forget(event.chat_id)
+            left, initiated = await left_channels.leave(client, event.chat_id)
+            
+            if initiated and left:
+                notify(
+                    context.bot,
+                    telegram_chat_id,
+                    f"Автоматический выход из группы/канала, в который вас добавили",
+                    priority=NOTIFY_STATUS
+                )
+            elif initiated:
+                notify(
+                    context.bot,
+                    telegram_chat_id,
+                    f"Не удалось выйти из группы, в которую вас добавили",
+                    priority=NOTIFY_ERROR
+                )
+    
+    async def handle_entity_update(update):
+        """Сброс кэшированных данных пользователя или чата при их изменении"""
+        peer_id = get_updated_peer_id(update)
+        if peer_id is not None:
+            get_entity_cache(client).invalidate(peer_id)
+        
+        # Изменение собственного профиля
+        identity = get_client_identity(client)
+        if identity and peer_id == identity.id:
+            if isinstance(update, UpdateUserName):
+                usernames = [u.username for u in update.usernames if u.active]
+                client_identities[client] = identity._replace(
+                    username=usernames[0] if usernames else None
+                )
+            else:
+                await refresh_client_identity(client)
+    
+    async def handle_dialog_update(update):
+        """Обновление состояния чатов при изменении уведомлений или архива"""
+        get_dialog_state(client).apply_update(update)
+    
+    # Установка user_id в context для ссылки в обработчиках событий
+    context.user_data['user_id'] = telegram_chat_id
+    
+    # Регистрация обработчиков (ранее подключенные обработчики клиента снимаются)
+    # Сообщения и действия в чатах обрабатываются диспетчером: параллельно по чатам,
+    # по порядку внутри одного чата
+    dispatcher = get_event_dispatcher(client)
+    attach_event_handlers(client, [
+        (dispatch_by_chat(dispatcher, handle_new_message), events.NewMessage(incoming=True)),
+        (handle_outgoing_start, events.NewMessage(outgoing=True, pattern=r'^/start')),
+        (dispatch_by_chat(dispatcher, handle_chat_action), events.ChatAction()),
+        (handle_entity_update, events.Raw(types=(UpdateUserName, UpdateUser, UpdateChannel, UpdateChat))),
+        (handle_dialog_update, events.Raw(types=(UpdateNotifySettings, UpdateFolderPeers))),
+    ])
+    
+    logger.info(f"Telethon обработчики событий настроены для пользователя {telegram_chat_id}")
+
+# Пересылка медиафайлов
 
-# Константы для API Telegram
-TELEGRAM_BOT_TOKEN = os.environ.get('6260969950:AAHCrisYmgFrxKvO-PzlMdU03IUF4aX6fYM')
-API_ID = int(os.environ.get('TELEGRAM_API_ID', '26540663'))  # With default value
-API_HASH = os.environ.get('38d8a00867f4e1b561c108eb487bcea7')
+# Максимальный размер пересылаемого файла в байтах (больше - пересылаются только сведения о файле)
+MEDIA_MAX_SIZE = int(os.environ.get('MEDIA_MAX_SIZE', str(20 * 1024 * 1024)))
+# Размер части при загрузке файла (кратен 4 КБ, не больше 512 КБ)
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', str(128 * 1024)))
+# Количество одновременно пересылаемых файлов
+MEDIA_CONCURRENCY = int(os.environ.get('MEDIA_CONCURRENCY', '3'))
+# Количество запоминаемых пересланных файлов для отбрасывания повторов
+MEDIA_DEDUP_SIZE = int(os.environ.get('MEDIA_DEDUP_SIZE', '10000'))
 
-# Основная директория для хранения данных пользователей
-DATA_DIR = Path('data')
-if not DATA_DIR.exists():
-    DATA_DIR.mkdir()
+# Названия типов медиафайлов
+MEDIA_NAMES = {
+    'photo': "Фото",
+    'video': "Видео",
+    'voice': "Голосовое сообщение",
+    'audio': "Аудио",
+    'document': "Документ",
+}
 
-# Словарь для отслеживания активных клиентов
-active_clients = {}
+def get_media_kind(message):
+    """Тип пересылаемого медиафайла сообщения (None, если файла нет)"""
+    # message.photo возвращает и картинку предпросмотра ссылки, поэтому тип определяется по самому вложению
+    media = getattr(message, 'media', None)
+    if isinstance(media, MessageMediaPhoto):
+        return 'photo' if media.photo else None
+    if not isinstance(media, MessageMediaDocument) or not media.document:
+        return None
+    if getattr(message, 'voice', None):
+        return 'voice'
+    if getattr(message, 'video', None) or getattr(message, 'video_note', None):
+        return 'video'
+    if getattr(message, 'audio', None):
+        return 'audio'
+    if getattr(message, 'document', None):
+        return 'document'
+    return None
 
-# Функции для работы с хранилищем
+def get_media_file(message):
+    """Фото или документ вложения сообщения (ID используется для отбрасывания повторов)"""
+    media = getattr(message, 'media', None)
+    if isinstance(media, MessageMediaPhoto):
+        return media.photo
+    if isinstance(media, MessageMediaDocument):
+        return media.document
+    return None
 
-def get_user_config_path(user_id):
-    """Получить путь к файлу конфигурации пользователя"""
-    return DATA_DIR / f"user_{user_id}_config.json"
+def describe_media(message):
+    """Читаемое описание медиафайла сообщения"""
+    kind = get_media_kind(message)
+    if kind is None:
+        return "Медиа"
+    name = getattr(getattr(message, 'file', None), 'name', None)
+    return f"{MEDIA_NAMES[kind]} {name}" if kind == 'document' and name else MEDIA_NAMES[kind]
 
-def get_session_path(user_id):
-    """Получить путь к файлу сессии Telethon для пользователя"""
-    return str(DATA_DIR / f"user_{user_id}")
+def format_size(size):
+    """Размер файла в читаемом виде"""
+    if size is None:
+        return "размер неизвестен"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    return f"{size / (1024 * 1024):.1f} МБ"
 
-def save_session(user_id):
-    """Пометить, что у пользователя есть действительная сессия"""
-    config_path = get_user_config_path(user_id)
-    config = {}
+class ForwardedMedia:
+    """Пересланные медиафайлы (по чату и ID файла) для отбрасывания повторов"""
     
-    if config_path.exists():
-        with open(config_path, 'r') as f:
-            try:
-                config = json.load(f)
-            except json.JSONDecodeError:
-                config = {}
+    def __init__(self, max_size=MEDIA_DEDUP_SIZE):
+        self.max_size = max_size
+        self._seen = OrderedDict()
     
-    config['has_session'] = True
+    def add(self, chat_id, media_id):
+        """Запомнить файл; False, если он уже пересылался"""
+        key = (chat_id, media_id)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return False
+        self._seen[key] = True
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return True
     
-    with open(config_path, 'w') as f:
-        json.dump(config, f)
+    def discard(self, chat_id, media_id):
+        """Забыть файл (например, если пересылка не удалась)"""
+        self._seen.pop((chat_id, media_id), None)
 
-def load_session(user_id):
-    """Проверить, есть ли у пользователя действительная сессия"""
-    config_path = get_user_config_path(user_id)
-    
-    if not config_path.exists():
-        return False
-    
-    try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-            return config.get('has_session', False)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return False
+forwarded_media = ForwardedMedia()
 
-def save_user_mode(user_id, mode):
-    """Сохранить выбранный пользователем режим работы"""
-    config_path = get_user_config_path(user_id)
-    config = {}
+# Ограничение одновременных пересылок (создается внутри цикла событий)
+media_transfer_limit = None
+
+def get_media_transfer_limit():
+    """Семафор одновременных пересылок медиафайлов"""
+    global media_transfer_limit
+    if media_transfer_limit is None:
+        media_transfer_limit = asyncio.Semaphore(MEDIA_CONCURRENCY)
+    return media_transfer_limit
+
+async def download_media_buffer(client, message, max_size=MEDIA_MAX_SIZE):
+    """Загрузить файл сообщения в память по частям; None, если он больше лимита"""
+    buffer = io.BytesIO()
+    async for chunk in client.iter_download(message.media, request_size=MEDIA_CHUNK_SIZE):
+        buffer.write(chunk)
+        if buffer.tell() > max_size:
+            return None
+    return buffer.getvalue()
+
+# Фоновые пересылки медиафайлов (ссылки не дают задачам завершиться преждевременно)
+media_transfers = set()
+
+def forward_media(client, bot, chat_id, message, text, mode=2):
+    """Начать пересылку медиафайла в чат бота без записи на диск (в фоне)"""
+    file = message.file
+    media = get_media_file(message)
     
-    if config_path.exists():
-        with open(config_path, 'r') as f:
-            try:
-                config = json.load(f)
-            except json.JSONDecodeError:
-                config = {}
+    if media is not None and not forwarded_media.add(chat_id, media.id):
+        notify(bot, chat_id, f"{text}\n\n[{describe_media(message)} уже пересылался ранее]", priority=NOTIFY_CONTENT)
+        return None
     
-    config['mode'] = mode
+    if file is None or file.size is None or file.size > MEDIA_MAX_SIZE:
+        notify(bot, chat_id, oversize_media_text(message, text), priority=NOTIFY_CONTENT)
+        return None
     
-    with open(config_path, 'w') as f:
-        json.dump(config, f)
+    task = asyncio.create_task(transfer_media(client, bot, chat_id, message, text, mode))
+    media_transfers.add(task)
+    task.add_done_callback(media_transfers.discard)
+    return task
 
-def get_user_mode(user_id):
-    """Получить выбранный пользователем режим работы"""
-    config_path = get_user_config_path(user_id)
-    
-    if not config_path.exists():
-        return 1  # По умолчанию режим 1
+def oversize_media_text(message, text):
+    """Текст уведомления о файле, превышающем лимит пересылки"""
+    file = message.file
+    return (
+        f"{text}\n\n[{describe_media(message)}, {format_size(file.size if file else None)}: "
+        f"превышает лимит пересылки]"
+    )
+
+async def transfer_media(client, bot, chat_id, message, text, mode):
+    """Загрузить медиафайл в память и отправить его через планировщик уведомлений"""
+    kind = get_media_kind(message)
+    media = get_media_file(message)
+    sent = False
     
+    # Буфер файла живет только до завершения отправки, поэтому лимит ограничивает и память
     try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-            return config.get('mode', 1)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return 1
+        async with get_media_transfer_limit():
+            with pipeline_metrics.stage(mode, 'forward_media'):
+                data = await download_media_buffer(client, message)
+                if data is None:
+                    notify(bot, chat_id, oversize_media_text(message, text), priority=NOTIFY_CONTENT)
+                    sent = True
+                    return
+                
+                sent = await notification_scheduler.submit(
+                    bot, chat_id, text, NOTIFY_CONTENT, media=(kind, data, message.file.name)
+                )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при пересылке медиафайла в чат {chat_id}: {e}")
+        notify(
+            bot,
+            chat_id,
+            f"{text}\n\n[Не удалось переслать {describe_media(message).lower()}: {str(e)}]",
+            priority=NOTIFY_ERROR
+        )
+    finally:
+        # Файл, который не удалось отправить, можно переслать повторно
+        if not sent and media is not None:
+            forwarded_media.discard(chat_id, media.id)
 
-# Функции для работы с Telethon клиентом
+# Сводки сообщений (режим 3)
 
-async def init_telethon_client(user_id, phone=None):
-    """Инициализировать Telethon клиент для пользователя"""
-    session_path = get_session_path(user_id)
+# Окно накопления сводки в секундах
+DIGEST_WINDOW = float(os.environ.get('DIGEST_WINDOW', '900'))
+# Количество сообщений, после которого сводка отправляется раньше окончания окна
+DIGEST_MAX_MESSAGES = int(os.environ.get('DIGEST_MAX_MESSAGES', '50'))
+# Объем текста сводки в символах, после которого она отправляется раньше (более длинная сводка
+# разбивается на несколько сообщений по MESSAGE_TEXT_LIMIT)
+DIGEST_MAX_CHARS = int(os.environ.get('DIGEST_MAX_CHARS', '3500'))
+# Количество последних сообщений одного отправителя, попадающих в сводку
+DIGEST_SENDER_LIMIT = int(os.environ.get('DIGEST_SENDER_LIMIT', '5'))
+# Максимальная длина одного сообщения в сводке
+DIGEST_TEXT_LIMIT = int(os.environ.get('DIGEST_TEXT_LIMIT', '300'))
+# Каталог файлов с ненаправленными сводками
+DIGEST_DIR = DATA_DIR / 'digests'
+# Запас под заголовок сводки в подсчете ее объема
+DIGEST_HEADER_CHARS = 64
+
+def shorten_text(text, limit=DIGEST_TEXT_LIMIT):
+    """Обрезать текст до заданной длины"""
+    text = ' '.join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+class DigestBuffer:
+    """Накопленные для сводки сообщения одного чата бота с копией в файле"""
     
-    # Проверка, существует ли клиент и подключен ли он
-    if user_id in active_clients and active_clients[user_id].is_connected():
-        logger.info(f"Используется существующий клиент для пользователя {user_id}")
-        return active_clients[user_id]
+    def __init__(self, chat_id, path):
+        self.chat_id = chat_id
+        self.path = path
+        self.bot = None
+        # Имя отправителя -> [количество сообщений, последние сообщения]
+        self.senders = OrderedDict()
+        self.count = 0
+        self.chars = 0
+        self.started = None
+        self.timer = None
+        self._spool = None
     
-    logger.info(f"Создание нового клиента для пользователя {user_id}")
+    def add(self, sender_name, text, when, spool=True):
+        """Добавить сообщение; True, если сводку пора отправить"""
+        entry = self.senders.get(sender_name)
+        if entry is None:
+            entry = self.senders[sender_name] = [0, deque(maxlen=DIGEST_SENDER_LIMIT)]
+            self.chars += len(sender_name) + 8
+        
+        text = shorten_text(text)
+        if len(entry[1]) == entry[1].maxlen:
+            # Вытесняемое сообщение больше не попадет в сводку, вместо него выводится строка "… еще N ранее"
+            self.chars -= len(entry[1][0]) + 3
+            if entry[0] == len(entry[1]):
+                self.chars += 20
+        entry[0] += 1
+        entry[1].append(text)
+        self.count += 1
+        self.chars += len(text) + 3
+        if self.started is None:
+            self.started = when
+            self.chars += DIGEST_HEADER_CHARS
+        
+        if spool:
+            if self._spool is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._spool = open(self.path, 'a', encoding='utf-8')
+            self._spool.write(json.dumps({'t': when, 's': sender_name, 'm': text}, ensure_ascii=False) + '\n')
+            self._spool.flush()
+        
+        return self.count >= DIGEST_MAX_MESSAGES or self.chars >= DIGEST_MAX_CHARS
     
-    # Создание нового клиента с более надежными настройками
-    client = TelegramClient(
-        session_path, 
-        API_ID, 
-        API_HASH,
-        connection_retries=10,           # Более активные повторные попытки соединения
-        auto_reconnect=True,             # Автоматическое переподключение
-        retry_delay=1,                   # Задержка между повторными попытками в секундах
-        request_retries=10,              # Повторные попытки для запросов API
-        sequential_updates=True          # Обработка обновлений в последовательном порядке
-    )
+    def load(self):
+        """Загрузить сообщения, сохраненные до перезапуска"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                        self.add(item['s'], item['m'], item['t'], spool=False)
+                    except (ValueError, KeyError, TypeError):
+                        # Недописанная при сбое строка
+                        continue
+        except FileNotFoundError:
+            pass
     
-    # Важно: Для загрузки сохраненных настроек устройства
-    client.session.set_dc(2, '149.154.167.51', 443)
+    def render(self, limit=MESSAGE_TEXT_LIMIT):
+        """Текст сводки, разбитый на части не длиннее лимита сообщения"""
+        minutes = max(1, round((time.time() - self.started) / 60))
+        lines = [f"Сводка: {self.count} сообщ. от {len(self.senders)} отправителей за {minutes} мин."]
+        for sender_name, (count, texts) in self.senders.items():
+            lines.append("")
+            lines.append(f"{sender_name} ({count}):")
+            if count > len(texts):
+                lines.append(f"… еще {count - len(texts)} ранее")
+            lines.extend(f"• {text}" for text in texts)
+        
+        pages = []
+        page = ''
+        for line in lines:
+            line = line[:limit]
+            if page and len(page) + 1 + len(line) > limit:
+                pages.append(page)
+                page = line
+            else:
+                page = f"{page}\n{line}" if page else line
+        pages.append(page)
+        return pages
+    
+    def reset(self):
+        """Очистить накопленные сообщения и отменить таймер"""
+        self.senders.clear()
+        self.count = 0
+        self.chars = 0
+        self.started = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
     
-    # Подключение с логикой повторных попыток
-    for attempt in range(3):
+    def detach(self):
+        """Очистить буфер, переименовав его файл; возвращает путь к файлу отправляемой сводки"""
+        # Новые сообщения пишутся в новый файл, а старый удаляется только после отправки сводки
+        self.reset()
+        self.close()
+        sending = self.path.with_name(f"{self.path.name}.{time.time_ns()}")
         try:
-            await client.connect()
-            if await client.is_user_authorized():
-                logger.info(f"Пользователь {user_id} авторизован с сохраненной сессией")
-                
-                # Проверка сессии
-                me = await client.get_me()
-                if me:
-                    logger.info(f"Сессия подтверждена для пользователя {me.first_name} (ID: {me.id})")
-                else:
-                    logger.warning("Не удалось получить информацию о пользователе, хотя сессия активна")
-            break
-        except Exception as e:
-            logger.error(f"Ошибка при подключении клиента (попытка {attempt+1}/3): {e}")
-            if attempt == 2:  # Последняя попытка не удалась
-                raise
+            self.path.rename(sending)
+        except FileNotFoundError:
+            return None
+        return sending
     
-    # Сохранение клиента в словаре
-    active_clients[user_id] = client
+    def clear(self):
+        """Очистить буфер и удалить его файл"""
+        self.reset()
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
     
-    return client
+    def close(self):
+        """Закрыть файл буфера"""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
 
-async def login_with_code(client, phone, code):
-    """Вход с использованием предоставленного кода подтверждения"""
-    try:
-        # Специальный флаг для авторизации без вытеснения других сессий
-        # Учитывая, что стандартного решения нет, можно экспериментально попробовать
-        # следующие параметры:
+# Буферы сводок по ID чата бота
+digest_buffers = {}
+
+def get_digest_buffer(chat_id):
+    """Получить буфер сводки чата (с сообщениями из файла после перезапуска)"""
+    buffer = digest_buffers.get(chat_id)
+    if buffer is None:
+        buffer = digest_buffers[chat_id] = DigestBuffer(chat_id, DIGEST_DIR / f"{chat_id}.jsonl")
+        buffer.load()
+    return buffer
+
+def schedule_digest(buffer):
+    """Запланировать отправку сводки по окончании окна"""
+    if buffer.timer is None and buffer.count:
+        delay = max(0.0, buffer.started + DIGEST_WINDOW - time.time())
+        buffer.timer = asyncio.get_running_loop().call_later(delay, flush_digest, buffer.chat_id)
+
+def add_to_digest(bot, chat_id, sender_name, text):
+    """Добавить пересылаемое сообщение в сводку"""
+    buffer = get_digest_buffer(chat_id)
+    buffer.bot = bot
+    if buffer.add(sender_name, text, time.time()):
+        flush_digest(chat_id)
+    else:
+        schedule_digest(buffer)
+
+def flush_digest(chat_id):
+    """Отправить накопленную сводку одним уведомлением"""
+    buffer = digest_buffers.get(chat_id)
+    if buffer is None or not buffer.count:
+        return
+    if buffer.bot is None:
+        logger.error(f"Нет бота для отправки сводки в чат {chat_id}")
+        return
+    
+    pages = buffer.render()
+    sending = buffer.detach()
+    done = asyncio.gather(*(
+        notification_scheduler.submit(buffer.bot, chat_id, page, priority=NOTIFY_CONTENT)
+        for page in pages
+    ))
+    done.add_done_callback(functools.partial(digest_sent, chat_id, sending))
+
+def digest_sent(chat_id, path, done):
+    """Удалить файл сводки после отправки всех ее частей"""
+    if not done.cancelled() and done.exception() is None and all(done.result()):
+        if path is not None:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        return
+    # Файл остается и объединяется с новыми сообщениями чата после перезапуска
+    logger.warning(f"Сводка для чата {chat_id} не отправлена, она будет повторена после перезапуска")
+
+def merge_digest_spools():
+    """Вернуть сообщения неотправленных сводок в файлы накопления их чатов"""
+    sending = {}
+    for path in DIGEST_DIR.glob('*.jsonl.*'):
+        chat_file, _, stamp = path.name.rpartition('.')
+        if stamp.isdigit():
+            sending.setdefault(chat_file, []).append((int(stamp), path))
+    
+    for chat_file, parts in sending.items():
+        # Более ранние сообщения идут первыми, затем накопленные после отправки
+        paths = [path for _, path in sorted(parts)] + [DIGEST_DIR / chat_file]
+        merged = DIGEST_DIR / f"{chat_file}.tmp"
+        with open(merged, 'w', encoding='utf-8') as out:
+            for path in paths:
+                try:
+                    data = path.read_text(encoding='utf-8')
+                except FileNotFoundError:
+                    continue
+                if data and not data.endswith('\n'):
+                    data += '\n'
+                out.write(data)
+        os.replace(merged, DIGEST_DIR / chat_file)
+        for _, path in parts:
+            path.unlink()
+
+def restore_digests(bot):
+    """Запланировать отправку сводок, сохраненных до перезапуска"""
+    if not DIGEST_DIR.exists():
+        return
+    merge_digest_spools()
+    for path in DIGEST_DIR.glob('*.jsonl'):
+        try:
+            chat_id = int(path.stem)
+        except ValueError:
+            continue
+        buffer = get_digest_buffer(chat_id)
+        if not buffer.count:
+            buffer.clear()
+            continue
+        buffer.bot = bot
+        schedule_digest(buffer)
+        logger.info(f"Восстановлена сводка для чата {chat_id}: {buffer.count} сообщений")
+
+def close_digest_spools():
+    """Закрыть файлы сводок и отменить таймеры"""
+    for buffer in digest_buffers.values():
+        if buffer.timer is not None:
+            buffer.timer.cancel()
+            buffer.timer = None
+        buffer.close()
+
+# Полнотекстовый индекс пересланных сообщений
+
+# Файл базы индекса сообщений
+MESSAGE_INDEX_DB_PATH = DATA_DIR / 'messages.db'
+# Срок хранения сообщений в днях
+MESSAGE_INDEX_RETENTION_DAYS = int(os.environ.get('MESSAGE_INDEX_RETENTION_DAYS', '180'))
+# Максимальное количество хранимых сообщений одного пользователя
+MESSAGE_INDEX_USER_LIMIT = int(os.environ.get('MESSAGE_INDEX_USER_LIMIT', '200000'))
+# Максимальная длина сохраняемого текста сообщения
+MESSAGE_INDEX_TEXT_LIMIT = int(os.environ.get('MESSAGE_INDEX_TEXT_LIMIT', '4096'))
+# Интервал очистки устаревших сообщений и сжатия индекса в секундах
+MESSAGE_INDEX_COMPACT_INTERVAL = float(os.environ.get('MESSAGE_INDEX_COMPACT_INTERVAL', '3600'))
+# Количество строк, удаляемых за одну транзакцию очистки
+MESSAGE_INDEX_COMPACT_BATCH = int(os.environ.get('MESSAGE_INDEX_COMPACT_BATCH', '500'))
+# Пауза между транзакциями очистки в секундах (больше шага ожидания блокировки SQLite)
+MESSAGE_INDEX_COMPACT_PAUSE = float(os.environ.get('MESSAGE_INDEX_COMPACT_PAUSE', '0.1'))
+# Количество результатов поиска в ответе
+SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT', '10'))
+
+def build_fts_query(text, column=None):
+    """Запрос FTS5 из слов пользователя: все слова, каждое как префикс"""
+    tokens = re.findall(r'\w+', text)
+    if not tokens:
+        return None
+    query = ' '.join(f'"{token}"*' for token in tokens)
+    return f'{column} : ({query})' if column else query
+
+class MessageIndex(BatchedSqliteStore):
+    """Хранилище пересланных сообщений с инкрементальным индексом SQLite FTS5"""
+    
+    # Освобожденные при очистке страницы возвращаются через incremental_vacuum
+    init_pragmas = ('PRAGMA auto_vacuum=INCREMENTAL',)
+    
+    def __init__(self, db_path=MESSAGE_INDEX_DB_PATH, batch_size=STORAGE_BATCH_SIZE,
+                 commit_interval=STORAGE_COMMIT_INTERVAL):
+        super().__init__(db_path, batch_size, commit_interval)
+        self._last_compact = 0.0
+        self._compacting = False
         
-        # 1. Вход со специальными параметрами
-        await client.sign_in(
-            phone=phone, 
-            code=code,
-            # Пытаемся указать, что хотим сохранить существующие сессии 
-            settings=None,  
-            # Не отключать другие устройства
-            sign_up=False
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY, owner INTEGER NOT NULL, date INTEGER NOT NULL, '
+            'sender TEXT NOT NULL, text TEXT NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS messages_owner ON messages (owner, id)')
+        # Индекс ссылается на текст в таблице messages и не хранит его копию
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "text, sender, content='messages', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
         )
+        self._conn.execute(
+            'CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN '
+            'INSERT INTO messages_fts (rowid, text, sender) VALUES (new.id, new.text, new.sender); END'
+        )
+        self._conn.execute(
+            'CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN '
+            "INSERT INTO messages_fts (messages_fts, rowid, text, sender) "
+            "VALUES ('delete', old.id, old.text, old.sender); END"
+        )
+        self._conn.commit()
+    
+    def add(self, owner, sender_name, text, date=None):
+        """Добавить сообщение; фиксация выполняется пакетами"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO messages (owner, date, sender, text) VALUES (?, ?, ?, ?)',
+                (owner, int(date if date is not None else time.time()), sender_name,
+                 text[:MESSAGE_INDEX_TEXT_LIMIT])
+            )
+            self._written()
         
-        # Проверка, что успешно вошли
-        if await client.is_user_authorized():
-            logger.info(f"Успешный вход с номера {phone} с сохранением других сессий")
-            return True
-        else:
-            logger.error(f"Не удалось авторизоваться с номера {phone} после sign_in")
-            return False
-    except Exception as e:
-        logger.error(f"Ошибка при входе через код подтверждения: {e}")
-        raise
-
-async def setup_telethon_event_handlers(client, telegram_chat_id, context):
-    """Настройка обработчиков событий для Telethon клиента"""
+        if time.monotonic() - self._last_compact >= MESSAGE_INDEX_COMPACT_INTERVAL:
+            self._schedule_compact()
     
-    @client.on(events.NewMessage())
-    async def handle_new_message(event):
-        """Обработка входящих сообщений в зависимости от выбранного режима"""
-        # Пропуск исходящих сообщений
-        if event.out:
+    def search(self, owner, query, limit=SEARCH_RESULTS_LIMIT):
+        """Последние сообщения, подходящие под запрос FTS5: (дата, отправитель, фрагмент)"""
+        # Обход индекса в обратном порядке rowid завершается после limit совпадений без сортировки
+        with self._lock:
+            return self._conn.execute(
+                "SELECT m.date, m.sender, snippet(messages_fts, 0, '«', '»', '…', 16) "
+                'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+                'WHERE messages_fts MATCH ? AND m.owner = ? '
+                'ORDER BY messages_fts.rowid DESC LIMIT ?',
+                (query, owner, limit)
+            ).fetchall()
+    
+    def count(self, owner=None):
+        """Количество хранимых сообщений"""
+        with self._lock:
+            if owner is None:
+                return self._conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE owner = ?', (owner,)
+            ).fetchone()[0]
+    
+    def _schedule_compact(self):
+        """Запустить очистку в отдельном потоке, не блокируя цикл событий"""
+        if self._compacting:
             return
-        
-        # Получение режима пользователя
-        user_id = context.user_data.get('user_id', telegram_chat_id)
-        mode = get_user_mode(user_id)
-        
+        self._compacting = True
+        self._last_compact = time.monotonic()
         try:
-            # Получение информации об отправителе
-            if event.is_channel:
-                sender = await event.get_chat()
-                sender_name = sender.title
-                is_channel = True
-            else:
-                sender = await event.get_sender()
-                sender_name = f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}".strip()
-                if not sender_name and hasattr(sender, 'title'):
-                    sender_name = sender.title
-                is_channel = False
+            asyncio.get_running_loop().run_in_executor(None, self.compact)
+        except RuntimeError:
+            self.compact()
+    
+    def compact(self, now=None):
+        """Удалить устаревшие и лишние сообщения и сжать индекс"""
+        cutoff = int((now if now is not None else time.time()) - MESSAGE_INDEX_RETENTION_DAYS * 86400)
+        # Отдельное соединение: благодаря WAL чтение не ждет очистку, а запись ждет не дольше одного пакета
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        try:
+            removed = self._delete_batches(
+                conn, 'SELECT id FROM messages WHERE date < ? ORDER BY id LIMIT ?', (cutoff,)
+            )
             
-            if is_channel:
-                # Выход из канала в обоих режимах
-                try:
-                    await client(LeaveChannelRequest(event.chat_id))
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Автоматический выход из канала: {sender_name}"
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка при выходе из канала: {e}")
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Не удалось выйти из канала {sender_name}: {str(e)}"
-                    )
-            elif mode == 1:
-                # Режим 1: Просто подтверждение
-                try:
-                    await event.reply("Ваше сообщение получено. Отвечу позже.")
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Получено сообщение от {sender_name}. Автоматически отправлен ответ с подтверждением."
+            owners = conn.execute(
+                'SELECT owner FROM messages GROUP BY owner HAVING COUNT(*) > ?',
+                (MESSAGE_INDEX_USER_LIMIT,)
+            ).fetchall()
+            for (owner,) in owners:
+                row = conn.execute(
+                    'SELECT id FROM messages WHERE owner = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                    (owner, MESSAGE_INDEX_USER_LIMIT)
+                ).fetchone()
+                if row is not None:
+                    removed += self._delete_batches(
+                        conn,
+                        'SELECT id FROM messages WHERE owner = ? AND id <= ? ORDER BY id LIMIT ?',
+                        (owner, row[0])
                     )
-                except Exception as e:
-                    logger.error(f"Ошибка в обработке Режима 1: {e}")
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Ошибка при обработке сообщения от {sender_name}: {str(e)}"
+            
+            if removed:
+                # Слияние сегментов индекса небольшими шагами, пока оно что-то меняет
+                while True:
+                    changes = conn.total_changes
+                    conn.execute(
+                        "INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', ?)",
+                        (MESSAGE_INDEX_COMPACT_BATCH // 10,)
                     )
-            else:  # Режим 2
-                # Проверка, является ли отправитель ботом
-                if hasattr(sender, 'bot') and sender.bot:
-                    # Проверка наличия сообщения /start в истории
-                    messages = await client.get_messages(sender, limit=20)
-                    found_start_message = False
-                    
-                    for msg in messages:
-                        if msg.out and msg.text and msg.text.startswith('/start'):
-                            found_start_message = True
-                            break
-                    
-                    if not found_start_message:
-                        # Блокировка бота
-                        try:
-                            await client(BlockRequest(sender.id))
-                            await context.bot.send_message(
-                                telegram_chat_id,
-                                f"Заблокирован бот: {sender_name} (не найдено сообщение /start)"
-                            )
-                            return
-                        except Exception as e:
-                            logger.error(f"Ошибка при блокировке бота: {e}")
-                            await context.bot.send_message(
-                                telegram_chat_id,
-                                f"Не удалось заблокировать бота {sender_name}: {str(e)}"
-                            )
+                    conn.commit()
+                    if conn.total_changes - changes < 2:
+                        break
+                    time.sleep(MESSAGE_INDEX_COMPACT_PAUSE)
                 
-                # Отключение уведомлений для этого чата
-                try:
-                    peer = await event.get_input_chat()
-                    await client(UpdateNotifySettingsRequest(
-                        peer=InputNotifyPeer(peer=peer),
-                        settings=InputPeerNotifySettings(
-                            show_previews=False,
-                            silent=True,
-                            mute_until=2147483647  # Очень далеко в будущем
-                        )
-                    ))
-                    
-                    logger.info(f"Отключены уведомления для: {sender_name}")
-                    
-                    # Архивирование через альтернативный метод
-                    try:
-                        # В текущей версии telethon нет прямого метода ArchiveRequest
-                        # Можно использовать client.edit_folder для архивирования
-                        await client.edit_folder([peer], 1)  # 1 = архивная папка
-                        logger.info(f"Чат отправлен в архив: {sender_name}")
-                    except Exception as e:
-                        # Если метод edit_folder не работает, просто логируем это
-                        logger.error(f"Не удалось архивировать чат: {e}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отключении уведомлений: {e}")
+                # Возврат свободных страниц файлу (executescript выполняет прагму до конца)
+                while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                    conn.executescript(f'PRAGMA incremental_vacuum({MESSAGE_INDEX_COMPACT_BATCH});')
+                    time.sleep(MESSAGE_INDEX_COMPACT_PAUSE)
                 
-                # Пересылка сообщения боту
-                try:
-                    await event.reply("Ваше сообщение получено.")
-                    
-                    # Пересылка содержимого сообщения
-                    message_text = event.message.text or event.message.message or "[Нет текстового содержимого]"
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Сообщение от {sender_name}:\n\n{message_text}"
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка в обработке Режима 2: {e}")
-                    await context.bot.send_message(
-                        telegram_chat_id,
-                        f"Ошибка при пересылке сообщения от {sender_name}: {str(e)}"
-                    )
-        
-        except Exception as e:
-            logger.error(f"Общая ошибка в обработчике событий: {e}")
-            await context.bot.send_message(
-                telegram_chat_id,
-                f"Ошибка обработки входящего сообщения: {str(e)}"
-            )
+                logger.info(f"Очистка индекса сообщений: удалено {removed}")
+            return removed
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при очистке индекса сообщений: {e}")
+            return 0
+        finally:
+            conn.close()
+            self._compacting = False
     
-    @client.on(events.ChatAction())
-    async def handle_chat_action(event):
-        """Обработка действий в чате, например, добавление в группу/канал"""
-        if event.user_added and event.user_id == client.get_me().id:
-            # Пользователь был добавлен в группу/канал, выходим из нее
-            try:
-                await client(LeaveChannelRequest(event.chat_id))
-                await context.bot.send_message(
-                    telegram_chat_id,
-                    f"Автоматический выход из группы/канала, в который вас добавили"
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при выходе из группы после добавления: {e}")
-                await context.bot.send_message(
-                    telegram_chat_id,
-                    f"Не удалось выйти из группы, в которую вас добавили: {str(e)}"
-                )
-    
-    # Установка user_id в context для ссылки в обработчиках событий
-    context.user_data['user_id'] = telegram_chat_id
-    
-    # Сохранение обработчиков для очистки при необходимости
-    if 'handlers' not in context.user_data:
-        context.user_data['handlers'] = []
+    def _delete_batches(self, conn, select_ids, params):
+        """Удалить строки, выбранные запросом, пакетами с фиксацией после каждого"""
+        removed = 0
+        while True:
+            deleted = conn.execute(
+                f'DELETE FROM messages WHERE id IN ({select_ids})',
+                params + (MESSAGE_INDEX_COMPACT_BATCH,)
+            ).rowcount
+            conn.commit()
+            removed += deleted
+            if deleted < MESSAGE_INDEX_COMPACT_BATCH:
+                return removed
+            # Запись из цикла событий успевает получить блокировку между пакетами
+            time.sleep(MESSAGE_INDEX_COMPACT_PAUSE)
+
+# Индекс сообщений (открывается при первом обращении)
+message_index = None
+message_index_unavailable = False
+
+def get_message_index():
+    """Получить индекс сообщений (None, если SQLite собран без FTS5)"""
+    global message_index, message_index_unavailable
+    if message_index is None and not message_index_unavailable:
+        try:
+            message_index = MessageIndex()
+            atexit.register(message_index.close)
+        except sqlite3.OperationalError as e:
+            logger.error(f"Полнотекстовый индекс сообщений недоступен: {e}")
+            message_index_unavailable = True
+    return message_index
+
+def index_message(owner, sender_name, text, message=None):
+    """Сохранить пересланное сообщение в индексе для поиска"""
+    index = get_message_index()
+    if index is None:
+        return
+    date = getattr(message, 'date', None)
+    try:
+        index.add(owner, sender_name, text, date.timestamp() if date else None)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при сохранении сообщения в индексе: {e}")
+
+# Восстановление сессий при запуске
+
+# Количество сессий, восстанавливаемых одновременно
+RESTORE_CONCURRENCY = int(os.environ.get('RESTORE_CONCURRENCY', '10'))
+# Количество попыток восстановления одной сессии
+RESTORE_ATTEMPTS = int(os.environ.get('RESTORE_ATTEMPTS', '3'))
+# Базовая задержка между попытками в секундах (удваивается, со случайным разбросом)
+RESTORE_BACKOFF = float(os.environ.get('RESTORE_BACKOFF', '2'))
+
+# Итоги восстановления сессий при запуске
+boot_stats = {}
+
+def list_session_users():
+    """Получить ID пользователей с сохраненной сессией"""
+    return [user_id for user_id, config in config_storage.iter_configs() if config.get('has_session')]
+
+async def restore_user_session(application, user_id, semaphore):
+    """Подключить клиент пользователя и подключить обработчики событий"""
+    for attempt in range(RESTORE_ATTEMPTS):
+        try:
+            async with semaphore:
+                client = await init_telethon_client(user_id)
+                if not await client.is_user_authorized():
+                    # Сессия отозвана - пользователю нужно заново пройти авторизацию
+                    logger.warning(f"Сессия пользователя {user_id} недействительна")
+                    update_user_config(user_id, has_session=False)
+                    return False
+                
+                context = application.context_types.context(application, chat_id=user_id, user_id=user_id)
+                await setup_telethon_event_handlers(client, user_id, context)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при восстановлении сессии пользователя {user_id} "
+                         f"(попытка {attempt+1}/{RESTORE_ATTEMPTS}): {e}")
+            if attempt + 1 < RESTORE_ATTEMPTS:
+                await asyncio.sleep(RESTORE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+    return False
+
+async def restore_sessions(application):
+    """Параллельно восстановить клиенты всех пользователей с сохраненной сессией"""
+    started = time.perf_counter()
+    user_ids = list_session_users()
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
     
-    context.user_data['handlers'].append(handle_new_message)
-    context.user_data['handlers'].append(handle_chat_action)
+    results = await asyncio.gather(*(
+        restore_user_session(application, user_id, semaphore) for user_id in user_ids
+    ))
     
-    logger.info(f"Telethon обработчики событий настроены для пользователя {telegram_chat_id}")
+    boot_stats.update(
+        users=len(user_ids),
+        restored=sum(results),
+        failed=len(results) - sum(results),
+        duration=time.perf_counter() - started
+    )
+    logger.info(f"Восстановлено сессий: {boot_stats['restored']} из {len(user_ids)} "
+                f"за {boot_stats['duration']:.2f} с")
+    return boot_stats
+
+async def start_session_restore(application: Application) -> None:
+    """Запуск восстановления сессий в фоне, чтобы бот сразу начал принимать обновления"""
+    # Сигнатура совместима с Application.builder().post_init()
+    restore_digests(application.bot)
+    application.create_task(restore_sessions(application))
 
 # Вспомогательные функции
 
 async def block_user(client, user_id):
     """Блокировать пользователя с помощью клиента Telethon"""
     try:
-        await client(BlockRequest(user_id))
+        await get_request_executor(client).call(
+            'BlockRequest',
+            lambda: client(BlockRequest(user_id), flood_sleep_threshold=0),
+            priority=REQUEST_URGENT,
+            key=('block', utils.get_peer_id(user_id))
+        )
         return True
     except Exception as e:
         logger.error(f"Ошибка при блокировке пользователя {user_id}: {e}")
@@ -367,7 +2988,12 @@ async def block_user(client, user_id):
 async def leave_channel(client, channel_id):
     """Покинуть канал с помощью клиента Telethon"""
     try:
-        await client(LeaveChannelRequest(channel_id))
+        await get_request_executor(client).call(
+            'LeaveChannelRequest',
+            lambda: client(LeaveChannelRequest(channel_id), flood_sleep_threshold=0),
+            priority=REQUEST_URGENT,
+            key=('leave', channel_id)
+        )
         return True
     except Exception as e:
         logger.error(f"Ошибка при выходе из канала {channel_id}: {e}")
@@ -381,6 +3007,9 @@ def parse_message_content(message):
         return message.caption
     elif hasattr(message, 'message') and message.message:
         return message.message
+    elif getattr(message, 'media', None):
+        # Медиафайл без подписи
+        return f"[{describe_media(message)}]"
     else:
         return "[Нет текстового содержимого]"
 
@@ -388,8 +3017,8 @@ def get_sender_name(sender):
     """Извлечение читаемого имени из объекта отправителя"""
     if hasattr(sender, 'first_name'):
         if hasattr(sender, 'last_name') and sender.last_name:
-            return f"{sender.first_name} {sender.last_name}"
-        return sender.first_name
+            return f"{sender.first_name or ''} {sender.last_name}".strip()
+        return sender.first_name or "Неизвестный отправитель"
     elif hasattr(sender, 'title'):
         return sender.title
     else:
@@ -402,10 +3031,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     
     if load_session(user.id):
+        # Клиент, отключенный по простою, снова начинает получать сообщения
+        await client_manager.resume(user.id)
+        
         # Пользователь уже авторизован, предлагаем выбрать режим
         keyboard = [
             [InlineKeyboardButton("Режим 1: Отвечать автоматически", callback_data="1")],
-            [InlineKeyboardButton("Режим 2: Пересылать сообщения мне", callback_data="2")]
+            [InlineKeyboardButton("Режим 2: Пересылать сообщения мне", callback_data="2")],
+            [InlineKeyboardButton("Режим 3: Присылать сводки сообщений", callback_data="3")]
         ]
         await update.message.reply_text(
             "Выберите режим работы бота:",
@@ -459,7 +3092,8 @@ async def receive_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
                 "Вы уже авторизованы в Telegram. Выберите режим работы бота:",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("Режим 1: Отвечать автоматически", callback_data="1")],
-                    [InlineKeyboardButton("Режим 2: Пересылать сообщения мне", callback_data="2")]
+                    [InlineKeyboardButton("Режим 2: Пересылать сообщения мне", callback_data="2")],
+                    [InlineKeyboardButton("Режим 3: Присылать сводки сообщений", callback_data="3")]
                 ])
             )
             return OPERATIONAL
@@ -502,4 +3136,143 @@ async def request_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     # Отправка сообщения с клавиатурой
     message = await update.message.reply_text(
         "Вам был отправлен код подтверждения в Telegram. "
-        "Введите его с помощью клави
+        "Введите его с помощью клавиатуры ниже.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    
+    # Сохранение сообщения для последующего обновления введенного кода
+    context.user_data['code_message_id'] = message.message_id
+    context.user_data['code'] = ''
+    return CODE_INPUT
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показать задержки этапов обработки сообщений (p50/p95/p99)."""
+    lines = ["Задержки обработки сообщений (мс):"]
+    for (mode, stage), metrics in sorted(pipeline_metrics.stages.items(), key=lambda item: str(item[0])):
+        p50, p95, p99 = (value * 1000 for value in metrics.percentiles(0.5, 0.95, 0.99))
+        lines.append(
+            f"Режим {mode}, {stage}: p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} "
+            f"(успешно {metrics.ok}, ошибок {metrics.errors})"
+        )
+    if len(lines) == 1:
+        lines.append("Данных пока нет.")
+    
+    queue = notification_scheduler.stats()
+    cache = config_cache.stats()
+    lines.append("")
+    lines.append(
+        f"Очередь уведомлений: {queue['depth']}, ожидание p95={queue['wait_p95'] * 1000:.1f} мс"
+    )
+    lines.append(f"Кэш конфигураций: попаданий {cache['hits']}, промахов {cache['misses']}")
+    lines.append(f"Подавлено автоответов: {reply_cooldown.suppressed}")
+    if boot_stats:
+        lines.append(
+            f"Восстановление сессий при запуске: {boot_stats['restored']} из {boot_stats['users']} "
+            f"за {boot_stats['duration']:.2f} с"
+        )
+    
+    dispatchers = [dispatcher.stats() for dispatcher in list(event_dispatchers.values())]
+    if dispatchers:
+        lines.append(
+            f"Очередь событий: {sum(d['pending'] for d in dispatchers)}, "
+            f"задержка p99={max(d['latency_p99'] for d in dispatchers) * 1000:.1f} мс"
+        )
+    
+    clients = client_manager.stats()
+    if clients:
+        suspended = [user_id for user_id, client in clients.items() if client['suspended']]
+        lines.append(
+            f"Клиенты: подключено {sum(client['connected'] for client in clients.values())}, "
+            f"отключено по простою {len(suspended)}"
+        )
+        if suspended:
+            lines.append(f"Отключены (без приема сообщений): {', '.join(map(str, suspended))}")
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Просмотр и изменение правил обработки входящих сообщений."""
+    user_id = update.effective_user.id
+    argument = update.message.text.partition(' ')[2].strip()
+    
+    if not argument:
+        rules = read_user_config(user_id).get('rules') or []
+        if rules:
+            text = "Ваши правила:\n" + json.dumps(rules, ensure_ascii=False, indent=2)
+        else:
+            text = "Правил нет, сообщения обрабатываются по выбранному режиму."
+        await update.message.reply_text(
+            f"{text}\n\n"
+            "Задать правила: /rules [{\"sender\": \"bot\", \"keywords\": [\"казино\"], \"action\": \"block\"}]\n"
+            f"Поля: sender ({', '.join(RULE_SENDER_TYPES)}), keywords, regex (синтаксис RE2), chats, exclude_chats, "
+            f"action ({', '.join(RULE_ACTIONS)}), text. Удалить все правила: /rules clear"
+        )
+        return
+    
+    try:
+        rules = [] if argument == 'clear' else json.loads(argument)
+        if isinstance(rules, dict):
+            rules = [rules]
+        save_user_rules(user_id, rules)
+    except ValueError as e:
+        await update.message.reply_text(f"Правила не сохранены: {e}")
+        return
+    
+    await update.message.reply_text(f"Сохранено правил: {len(rules)}")
+
+async def reply_search_results(update, query):
+    """Выполнить поиск по индексу сообщений и отправить результаты"""
+    index = get_message_index()
+    if index is None:
+        await update.message.reply_text("Поиск по сообщениям недоступен.")
+        return
+    
+    started = time.perf_counter()
+    try:
+        rows = index.search(update.effective_chat.id, query)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка поиска по сообщениям: {e}")
+        await update.message.reply_text("Не удалось выполнить поиск.")
+        return
+    elapsed = (time.perf_counter() - started) * 1000
+    
+    if not rows:
+        await update.message.reply_text(f"Ничего не найдено ({elapsed:.0f} мс).")
+        return
+    
+    lines = [f"Последние найденные сообщения ({elapsed:.0f} мс):"]
+    for date, sender_name, fragment in rows:
+        lines.append("")
+        lines.append(f"{datetime.fromtimestamp(date).strftime('%d.%m.%Y %H:%M')} - {sender_name}:")
+        lines.append(fragment)
+    await update.message.reply_text("\n".join(lines)[:4096])
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Поиск по тексту пересланных сообщений."""
+    query = build_fts_query(update.message.text.partition(' ')[2])
+    if query is None:
+        await update.message.reply_text("Использование: /search <слова для поиска>")
+        return
+    await reply_search_results(update, query)
+
+async def from_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Последние пересланные сообщения от отправителя."""
+    query = build_fts_query(update.message.text.partition(' ')[2], column='sender')
+    if query is None:
+        await update.message.reply_text("Использование: /from <имя отправителя>")
+        return
+    await reply_search_results(update, query)
+
+async def resume_client_on_interaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Подключить клиент, отключенный по простою, при любом обращении пользователя к боту."""
+    if update.effective_user is not None:
+        await client_manager.resume(update.effective_user.id)
+
+def register_service_handlers(application: Application) -> None:
+    """Регистрация служебных команд бота"""
+    # Группа -1 обрабатывается раньше остальных и не мешает их срабатыванию
+    application.add_handler(TypeHandler(Update, resume_client_on_interaction), group=-1)
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("rules", rules_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("from", from_command))
@@ -0,0 +1,436 @@
+"""Оффлайн бенчмарк обработчиков Telethon без реальных аккаунтов
+
+Запуск: python benchmark.py --events 2000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+from telethon import events, utils
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Channel, Chat, ChatPhotoEmpty, User
+
+ROOT_DIR = Path(__file__).resolve().parent
+START_DIR = Path.cwd()
+sys.path.insert(0, str(ROOT_DIR))
+
+# Bot.py при импорте создает каталог data/ в текущей директории,
+# поэтому модуль загружается функцией import_bot() после перехода во временный каталог
+Bot = None
+
+# ID аккаунта, от имени которого работает поддельный клиент
+ME_ID = 1000
+# Чат пользователя с ботом, куда отправляются уведомления
+TELEGRAM_CHAT_ID = 777
+
+def import_bot():
+    """Импортировать Bot.py, создающий свои данные в текущей директории"""
+    global Bot
+    import Bot as module
+    Bot = module
+    # Шум логов искажает измерения
+    logging.getLogger('Bot').setLevel(logging.CRITICAL)
+    return module
+
+def apply_bot_defaults(args):
+    """Подставить значения по умолчанию из настроек Bot.py"""
+    if args.workers is None:
+        args.workers = [1, Bot.EVENT_WORKERS]
+    if args.queue_limit is None:
+        args.queue_limit = Bot.EVENT_QUEUE_LIMIT
+    if args.reply_cooldown is None:
+        args.reply_cooldown = Bot.AUTO_REPLY_COOLDOWN
+    return args
+
+def close_bot_storage():
+    """Закрыть файлы и базы Bot.py перед удалением временного каталога"""
+    if Bot is None:
+        return
+    Bot.close_digest_spools()
+    Bot.config_storage.close()
+    if Bot.message_index is not None:
+        Bot.message_index.close()
+
+def percentile(values, q):
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def git_version():
+    """Текущий коммит репозитория (для сравнения версий)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Поддельные объекты Telethon
+
+class FakeMessage:
+    """Сообщение Telethon с текстом"""
+
+    def __init__(self, text, out=False, id=1):
+        self.id = id
+        self.text = text
+        self.message = text
+        self.out = out
+
+class FakeNewMessageEvent:
+    """Событие NewMessage с имитацией задержки сетевых запросов"""
+
+    def __init__(self, client, chat, sender, text, out=False, slow=False):
+        self.client = client
+        self.slow = slow
+        if slow:
+            client.slow_peers.add(utils.get_peer_id(chat))
+        self._chat = chat
+        self._sender = sender
+        self.out = out
+        self.message = FakeMessage(text, out)
+        self.chat_id = utils.get_peer_id(chat)
+        self.sender_id = utils.get_peer_id(sender)
+        self.is_channel = isinstance(chat, Channel)
+        self.is_private = isinstance(chat, User)
+        self.is_group = isinstance(chat, Chat) or (self.is_channel and chat.megagroup)
+
+    async def get_chat(self):
+        await self.client.api_call('get_chat', self.slow)
+        return self._chat
+
+    async def get_sender(self):
+        await self.client.api_call('get_sender', self.slow)
+        return self._sender
+
+    async def get_input_chat(self):
+        return utils.get_input_peer(self._chat)
+
+    async def get_input_sender(self):
+        return utils.get_input_peer(self._sender)
+
+class FakeChatActionEvent:
+    """Событие ChatAction о добавлении пользователей в группу"""
+
+    def __init__(self, chat, user_ids):
+        self.chat_id = utils.get_peer_id(chat)
+        self.user_added = True
+        self.user_ids = user_ids
+        self.user_id = user_ids[0]
+
+class FakeMe:
+    """Результат get_me()"""
+
+    id = ME_ID
+    username = 'bench'
+    first_name = 'Bench'
+    premium = False
+
+class FakeTelegramClient:
+    """Клиент Telethon, который получает синтетические события и считает запросы к API"""
+
+    def __init__(self, api_latency, slow_latency, started_bots, flood_every=0):
+        self.api_latency = api_latency
+        self.flood_every = flood_every
+        self.requests = 0
+        self.slow_latency = slow_latency
+        self.started_bots = started_bots
+        self.slow_peers = set()
+        self.api_calls = {}
+        self.handler_runs = 0
+        self._handlers = []
+
+    async def api_call(self, name, slow=False):
+        """Учесть запрос к API и выждать сетевую задержку (у медленных чатов - увеличенную)"""
+        self.api_calls[name] = self.api_calls.get(name, 0) + 1
+        latency = self.slow_latency if slow else self.api_latency
+        if latency:
+            await asyncio.sleep(latency)
+
+    def is_connected(self):
+        return True
+
+    def add_event_handler(self, callback, event):
+        self._handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self._handlers = [(cb, ev) for cb, ev in self._handlers if cb is not callback]
+
+    def list_event_handlers(self):
+        return [(cb, ev) for cb, ev in self._handlers]
+
+    async def get_me(self):
+        await self.api_call('get_me')
+        return FakeMe()
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        peer = getattr(request, 'peer', None)
+        peer_id = utils.get_peer_id(peer) if peer is not None else None
+        await self.api_call(type(request).__name__, peer_id in self.slow_peers)
+        self.requests += 1
+        if self.flood_every and self.requests % self.flood_every == 0:
+            raise FloodWaitError(request, capture=0)
+        if type(request).__name__ == 'SearchRequest':
+            started = peer_id in self.started_bots
+            return SimpleNamespace(messages=[FakeMessage('/start', out=True)] if started else [])
+
+    def _matching_handlers(self, event):
+        """Обработчики, чьи фильтры подходят под событие"""
+        for callback, builder in self._handlers:
+            if isinstance(event, FakeNewMessageEvent) and isinstance(builder, events.NewMessage):
+                if builder.outgoing and not event.out:
+                    continue
+                if builder.incoming and event.out:
+                    continue
+                if builder.pattern and not builder.pattern(event.message.text or ''):
+                    continue
+                yield callback
+            elif isinstance(event, FakeChatActionEvent) and isinstance(builder, events.ChatAction):
+                yield callback
+
+    async def dispatch(self, event):
+        """Передать событие всем подходящим обработчикам по очереди (как sequential_updates)"""
+        for callback in self._matching_handlers(event):
+            self.handler_runs += 1
+            await callback(event)
+
+class FakeBot:
+    """Bot API с задержкой ответа и периодическими ошибками RetryAfter"""
+
+    def __init__(self, latency, retry_after_every, retry_after):
+        self.latency = latency
+        self.retry_after_every = retry_after_every
+        self.retry_after = retry_after
+        self.calls = 0
+        self.delivered = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_every and self.calls % self.retry_after_every == 0:
+            raise RetryAfter(timedelta(seconds=self.retry_after))
+        self.delivered += 1
+
+class FakeContext:
+    """Контекст python-telegram-bot с поддельным ботом"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_data = {}
+
+# Генерация нагрузки
+
+def make_user(user_id, bot=False):
+    return User(id=user_id, access_hash=user_id, first_name=f"User{user_id}", last_name=None, bot=bot)
+
+def make_channel(channel_id):
+    return Channel(
+        id=channel_id, access_hash=channel_id, title=f"Channel{channel_id}",
+        photo=ChatPhotoEmpty(), date=datetime.now(), broadcast=True
+    )
+
+def make_group(chat_id):
+    return Chat(
+        id=chat_id, title=f"Group{chat_id}", photo=ChatPhotoEmpty(),
+        participants_count=10, date=datetime.now(), version=1
+    )
+
+def generate_events(client, args, rng):
+    """Синтетическая смесь событий: личные чаты, боты, каналы, группы и добавления в группы"""
+    users = [make_user(2000 + i) for i in range(args.senders)]
+    # Часть собеседников отвечает медленно (например, чат под FloodWait)
+    slow_users = {user.id for user in users[:int(len(users) * args.slow_fraction)]}
+    bots = [make_user(5000 + i, bot=True) for i in range(max(1, args.senders // 10))]
+    channels = [make_channel(7000 + i) for i in range(max(1, args.senders // 10))]
+    groups = [make_group(9000 + i) for i in range(max(1, args.senders // 10))]
+
+    kinds = ['private', 'bot', 'channel', 'group', 'action']
+    weights = [args.private, args.bot, args.channel, args.group, args.action]
+
+    generated = []
+    for _ in range(args.events):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'private':
+            user = rng.choice(users)
+            generated.append((kind, FakeNewMessageEvent(client, user, user, 'hello', slow=user.id in slow_users)))
+        elif kind == 'bot':
+            bot = rng.choice(bots)
+            generated.append((kind, FakeNewMessageEvent(client, bot, bot, 'news')))
+        elif kind == 'channel':
+            channel = rng.choice(channels)
+            generated.append((kind, FakeNewMessageEvent(client, channel, channel, 'post')))
+        elif kind == 'group':
+            generated.append((kind, FakeNewMessageEvent(client, rng.choice(groups), rng.choice(users), 'hi all')))
+        else:
+            added = ME_ID if rng.random() < 0.5 else rng.choice(users).id
+            generated.append((kind, FakeChatActionEvent(rng.choice(groups), [added])))
+
+    started_bots = {bot.id for bot in bots[::2]}
+    return generated, started_bots
+
+def reset_bot_state(args):
+    """Сбросить глобальное состояние Bot.py между прогонами"""
+    Bot.pipeline_metrics = Bot.PipelineMetrics()
+    Bot.reply_cooldown = Bot.ReplyCooldown(args.reply_cooldown)
+    Bot.notification_scheduler = Bot.NotificationScheduler(
+        global_rate=args.bot_rate, chat_rate=args.bot_rate, chat_burst=args.bot_rate
+    )
+    Bot.started_bots_indexes.clear()
+    Bot.left_channels_registry.clear()
+    for chat_id in list(Bot.digest_buffers):
+        Bot.digest_buffers.pop(chat_id).clear()
+    Bot.update_user_config(TELEGRAM_CHAT_ID, started_bots=[], checked_bots=[], left_channels=[])
+
+async def run_mode(mode, workers, args):
+    """Прогнать поток событий через обработчики в указанном режиме"""
+    reset_bot_state(args)
+    rng = random.Random(args.seed)
+    client = FakeTelegramClient(args.api_latency, args.slow_latency, set(), args.flood_every)
+    generated, client.started_bots = generate_events(client, args, rng)
+
+    bot = FakeBot(args.bot_latency, args.retry_after_every, args.retry_after)
+    context = FakeContext(bot)
+    Bot.save_user_mode(TELEGRAM_CHAT_ID, mode)
+    Bot.dialog_states[client] = Bot.DialogStateTracker(window=args.archive_window)
+    dispatcher = Bot.event_dispatchers[client] = Bot.ChatOrderedDispatcher(
+        workers=workers, queue_limit=args.queue_limit
+    )
+
+    # Повторная настройка не должна дублировать обработчики
+    for _ in range(args.setup_repeats):
+        await Bot.setup_telethon_event_handlers(client, TELEGRAM_CHAT_ID, context)
+    client.api_calls.clear()
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    # Все события приходят одной пачкой; задержка события - от постановки в очередь
+    # диспетчера до завершения обработки
+    started = time.perf_counter()
+    for kind, event in generated:
+        await client.dispatch(event)
+    await dispatcher.join()
+    elapsed = time.perf_counter() - started
+    latencies = list(dispatcher.latencies)
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Завершение отложенной работы: пакетное архивирование, сводки и очередь уведомлений
+    await asyncio.sleep(args.archive_window * 2)
+    for chat_id in list(Bot.digest_buffers):
+        Bot.flush_digest(chat_id)
+    await Bot.notification_scheduler.flush(timeout=args.drain_timeout)
+
+    latencies.sort()
+    api_calls = sum(client.api_calls.values())
+    stages = {
+        f"{stage_mode}/{stage}": {
+            'count': metrics.ok + metrics.errors,
+            'errors': metrics.errors,
+            'p50_ms': metrics.percentiles(0.5)[0] * 1000,
+            'p99_ms': metrics.percentiles(0.99)[0] * 1000,
+        }
+        for (stage_mode, stage), metrics in Bot.pipeline_metrics.stages.items()
+    }
+
+    return {
+        'events': len(generated),
+        'elapsed_s': elapsed,
+        'events_per_s': len(generated) / elapsed if elapsed else 0.0,
+        'workers': workers,
+        'backpressure_waits': dispatcher.backpressure_waits,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': latencies[-1] * 1000 if latencies else 0.0,
+        },
+        'handler_runs_per_event': client.handler_runs / len(generated) if generated else 0.0,
+        'api_calls_per_event': api_calls / len(generated) if generated else 0.0,
+        'api_calls': dict(sorted(client.api_calls.items())),
+        'bot_api_calls_per_event': bot.calls / len(generated) if generated else 0.0,
+        'notifications': Bot.notification_scheduler.stats(),
+        'requests': Bot.get_request_executor(client).stats(),
+        'memory_growth_bytes': memory_after - memory_before,
+        'memory_peak_bytes': memory_peak,
+        'stages': stages,
+    }
+
+async def run(args):
+    results = {}
+    for mode in args.modes:
+        for workers in args.workers:
+            results[f"mode_{mode}_workers_{workers}"] = await run_mode(mode, workers, args)
+    return {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'results': results,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Оффлайн бенчмарк обработчиков Telethon")
+    parser.add_argument('--events', type=int, default=2000, help="количество событий в прогоне")
+    parser.add_argument('--senders', type=int, default=200, help="количество различных собеседников")
+    parser.add_argument('--modes', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--private', type=float, default=0.6, help="доля личных сообщений")
+    parser.add_argument('--bot', type=float, default=0.15, help="доля сообщений от ботов")
+    parser.add_argument('--channel', type=float, default=0.1, help="доля сообщений из каналов")
+    parser.add_argument('--group', type=float, default=0.1, help="доля сообщений из групп")
+    parser.add_argument('--action', type=float, default=0.05, help="доля событий ChatAction")
+    parser.add_argument('--api-latency', type=float, default=0.001, help="задержка MTProto запроса, с")
+    parser.add_argument('--slow-fraction', type=float, default=0.05, help="доля медленных собеседников")
+    parser.add_argument('--slow-latency', type=float, default=0.05, help="задержка запросов медленных чатов, с")
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="размеры пула диспетчера (1 - аналог последовательной обработки; "
+                             "по умолчанию 1 и EVENT_WORKERS)")
+    parser.add_argument('--queue-limit', type=int, default=None, help="по умолчанию EVENT_QUEUE_LIMIT")
+    parser.add_argument('--flood-every', type=int, default=100, help="FloodWait на каждый N-й запрос MTProto (0 - никогда)")
+    parser.add_argument('--bot-latency', type=float, default=0.001, help="задержка Bot API, с")
+    parser.add_argument('--bot-rate', type=float, default=1000, help="лимит Bot API в бенчмарке, сообщений/с")
+    parser.add_argument('--retry-after-every', type=int, default=50, help="RetryAfter на каждый N-й вызов (0 - никогда)")
+    parser.add_argument('--retry-after', type=float, default=0.01, help="значение RetryAfter, с")
+    parser.add_argument('--reply-cooldown', type=float, default=None, help="по умолчанию AUTO_REPLY_COOLDOWN")
+    parser.add_argument('--archive-window', type=float, default=0.05)
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    parser.add_argument('--setup-repeats', type=int, default=2, help="сколько раз вызывать настройку обработчиков")
+    parser.add_argument('--output', help="файл для результатов в формате JSON (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        os.chdir(workdir)
+        try:
+            import_bot()
+            apply_bot_defaults(args)
+            report = asyncio.run(run(args))
+        finally:
+            close_bot_storage()
+            os.chdir(START_DIR)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(START_DIR / args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
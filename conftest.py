@@ -0,0 +1,13 @@
+"""Общие фикстуры тестов"""
+import pytest
+
+import benchmark
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Bot.py, создающий свои данные во временном каталоге"""
+    monkeypatch.chdir(tmp_path)
+    module = benchmark.import_bot()
+    monkeypatch.setattr(module, 'pipeline_metrics', module.PipelineMetrics())
+    monkeypatch.setattr(module, 'reply_cooldown', module.ReplyCooldown())
+    return module
@@ -0,0 +1,169 @@
+"""Проверка однократной обработки событий Telethon на поддельном клиенте из benchmark.py"""
+import asyncio
+
+import benchmark
+
+def test_event_runs_through_pipeline_once(bot):
+    async def scenario():
+        client = benchmark.FakeTelegramClient(0, 0, set())
+        context = benchmark.FakeContext(benchmark.FakeBot(0, 0, 0))
+        bot.save_user_mode(benchmark.TELEGRAM_CHAT_ID, 1)
+
+        # Повторная настройка не должна дублировать обработчики
+        for _ in range(2):
+            await bot.setup_telethon_event_handlers(client, benchmark.TELEGRAM_CHAT_ID, context)
+        handlers = client.list_event_handlers()
+        assert len(handlers) == len(bot.client_handlers[client])
+
+        user = benchmark.make_user(2001)
+        await client.dispatch(benchmark.FakeNewMessageEvent(client, user, user, 'hello'))
+        await bot.get_event_dispatcher(client).join()
+
+        # Автоответ выполняется в фоне через исполнитель запросов
+        for _ in range(100):
+            if client.api_calls.get('SendMessageRequest'):
+                break
+            await asyncio.sleep(0.01)
+        await bot.notification_scheduler.flush(timeout=5)
+
+        assert client.handler_runs == 1
+        assert bot.pipeline_metrics.stages[(1, 'total')].ok == 1
+        assert client.api_calls.get('SendMessageRequest') == 1
+
+        bot.detach_event_handlers(client)
+        assert client.list_event_handlers() == []
+
+        # Завершение останавливает все фоновые задачи
+        await bot.shutdown_clients()
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(scenario())
+
+def test_link_preview_is_not_forwarded_as_media(bot):
+    from datetime import datetime
+    from telethon.tl.custom import Message
+    from telethon.tl.types import (Document, DocumentAttributeAudio, MessageMediaDocument, MessageMediaPhoto,
+                                   MessageMediaWebPage, PeerUser, Photo, PhotoSize, WebPage)
+
+    photo = Photo(id=5, access_hash=1, file_reference=b'', date=datetime.now(), sizes=[PhotoSize('x', 10, 10, 100)], dc_id=2)
+    preview = MessageMediaWebPage(webpage=WebPage(id=1, url='http://a', display_url='a', hash=0, photo=photo))
+    message = Message(id=1, peer_id=PeerUser(1), message='см. http://a', media=preview)
+    assert message.photo is not None
+    assert bot.get_media_kind(message) is None
+    assert bot.parse_message_content(message) == 'см. http://a'
+
+    message = Message(id=2, peer_id=PeerUser(1), message='', media=MessageMediaPhoto(photo=photo))
+    assert bot.get_media_kind(message) == 'photo'
+    assert bot.get_media_file(message) is photo
+
+    voice = Document(id=7, access_hash=1, file_reference=b'', date=datetime.now(), mime_type='audio/ogg', size=10, dc_id=2,
+                     attributes=[DocumentAttributeAudio(duration=3, voice=True)])
+    message = Message(id=3, peer_id=PeerUser(1), message='', media=MessageMediaDocument(document=voice))
+    assert bot.get_media_kind(message) == 'voice'
+    assert bot.get_media_file(message) is voice
+
+def test_executor_close_cancels_flood_wait_retries(bot):
+    async def scenario():
+        executor = bot.RequestExecutor(concurrency=1)
+
+        async def flood():
+            raise benchmark.FloodWaitError(None, capture=1)
+
+        future = executor.submit('flood', flood)
+        for _ in range(100):
+            if executor.stats()['deferred']:
+                break
+            await asyncio.sleep(0.01)
+        assert executor.stats()['deferred'] == 1
+
+        await asyncio.gather(*executor.close(), return_exceptions=True)
+        assert future.cancelled()
+        assert executor.stats()['deferred'] == 0
+
+        # Отмененный таймер не должен заново запустить обработчики
+        await asyncio.sleep(1.1)
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(scenario())
+
+def test_suspended_client_is_reconnected(bot):
+    class Client:
+        connected = True
+        catch_ups = 0
+
+        def is_connected(self):
+            return self.connected
+
+        async def connect(self):
+            self.connected = True
+
+        async def disconnect(self):
+            self.connected = False
+
+        async def catch_up(self):
+            self.catch_ups += 1
+
+    async def scenario():
+        manager = bot.ClientManager(idle_timeout=10, catch_up_interval=60)
+        client = Client()
+        manager.records[1] = bot.ClientRecord(client)
+
+        await manager.suspend(1)
+        assert manager.stats()[1]['suspended'] and not client.connected
+
+        # Обращение к боту подключает клиент и загружает пропущенные сообщения
+        await manager.resume(1)
+        assert client.connected and client.catch_ups == 1
+        assert not manager.stats()[1]['suspended']
+
+        # Периодическое подключение не продлевает простой: клиент снова отключается при следующей проверке
+        await manager.suspend(1)
+        now = manager.records[1].suspended_at + 60
+        await manager.catch_up(now)
+        assert client.connected and client.catch_ups == 2
+        manager.records[1].last_activity -= 20
+        await manager.sweep()
+        assert not client.connected
+
+    asyncio.run(scenario())
+
+def test_digest_spool_is_kept_until_summary_is_sent(bot, monkeypatch):
+    class Bot:
+        def __init__(self, fail):
+            self.fail = fail
+            self.sent = []
+
+        async def send_message(self, chat_id, text):
+            if self.fail:
+                raise RuntimeError('network')
+            self.sent.append(text)
+
+    async def scenario():
+        monkeypatch.setattr(bot, 'notification_scheduler', bot.NotificationScheduler(1000, 1000, 1000))
+        failing = Bot(fail=True)
+        for i in range(bot.DIGEST_MAX_MESSAGES):
+            bot.add_to_digest(failing, 7, f'Отправитель {i % 20}', 'x' * bot.DIGEST_TEXT_LIMIT)
+        await bot.notification_scheduler.flush(timeout=5)
+        await asyncio.sleep(0)
+
+        # Неотправленная сводка остается на диске и возвращается в буфер при перезапуске
+        assert list(bot.DIGEST_DIR.glob('7.jsonl.*'))
+        bot.close_digest_spools()
+        bot.digest_buffers.clear()
+        working = Bot(fail=False)
+        bot.restore_digests(working)
+        assert not list(bot.DIGEST_DIR.glob('7.jsonl.*'))
+        assert bot.digest_buffers[7].count == bot.DIGEST_MAX_MESSAGES
+
+        bot.flush_digest(7)
+        await bot.notification_scheduler.flush(timeout=5)
+        await asyncio.sleep(0)
+        assert len(working.sent) > 1
+        assert all(len(text) <= bot.MESSAGE_TEXT_LIMIT for text in working.sent)
+        assert not list(bot.DIGEST_DIR.iterdir())
+
+        bot.close_digest_spools()
+        bot.digest_buffers.clear()
+        await asyncio.gather(*bot.notification_scheduler.close())
+
+    asyncio.run(scenario())
@@ -0,0 +1,74 @@
+"""Проверка движка правил: автомат ключевых слов, фильтры и регулярные выражения"""
+import time
+
+import pytest
+
+def matched(rules, sender_type='user', chat_id=1, text=''):
+    return [rule.index for rule in rules.match(sender_type, chat_id, text)]
+
+def test_keyword_automaton_finds_overlapping_keywords(bot):
+    automaton = bot.KeywordAutomaton()
+    for bit, keyword in enumerate(['he', 'she', 'his', 'hers']):
+        automaton.add(keyword, 1 << bit)
+    automaton.build()
+
+    assert automaton.search('ushers') == 0b1011
+    assert automaton.search('this') == 0b0100
+    assert automaton.search('xyz') == 0
+
+def test_rules_filter_by_sender_chat_and_keywords(bot):
+    rules = bot.CompiledRules([
+        {'sender': 'bot', 'action': 'block'},
+        {'keywords': ['Казино', 'sale'], 'action': 'ignore'},
+        {'chats': [5], 'action': 'mute'},
+        {'exclude_chats': [7], 'action': 'forward'},
+    ])
+
+    assert matched(rules, 'bot', text='hi') == [0, 3]
+    assert matched(rules, text='Big SALE') == [1, 3]
+    assert matched(rules, 'group', text='казино!') == [1, 3]
+    assert matched(rules, chat_id=5) == [2, 3]
+    assert matched(rules, chat_id=7) == []
+
+def test_invalid_rules_are_rejected(bot):
+    for spec in [
+        {'action': 'explode'},
+        {'sender': 'robot', 'action': 'ignore'},
+        {'chats': ['abc'], 'action': 'ignore'},
+        'not a rule',
+    ]:
+        with pytest.raises(ValueError):
+            bot.CompiledRules([spec])
+
+    with pytest.raises(ValueError):
+        bot.CompiledRules({'action': 'ignore'})
+
+def test_regex_rules_match_case_insensitively(bot):
+    pytest.importorskip('re2')
+    rules = bot.CompiledRules([
+        {'regex': r'promo\d+', 'action': 'mute'},
+        {'regex': ['ПРИВЕТ', 'hello'], 'action': 'reply'},
+        {'action': 'forward'},
+    ])
+
+    assert matched(rules, text='Привет, PROMO12') == [0, 1, 2]
+    assert matched(rules, text='promo') == [2]
+
+def test_unsupported_regexes_are_rejected(bot):
+    pytest.importorskip('re2')
+    for pattern in [r'(a)\1', r'(?=x)y', '(', 'x' * (bot.RULE_REGEX_MAX_LENGTH + 1)]:
+        with pytest.raises(ValueError):
+            bot.CompiledRules([{'regex': pattern, 'action': 'ignore'}])
+
+def test_backtracking_patterns_run_in_linear_time(bot):
+    pytest.importorskip('re2')
+    cases = [
+        (r'^(a|a?)+$', 'a' * 26 + 'b'),
+        (r'(a|aa)+$', 'a' * 35 + 'b'),
+        (r'\w+\d+\w+x', '1' * bot.RULE_REGEX_TEXT_LIMIT),
+    ]
+    for pattern, text in cases:
+        rules = bot.CompiledRules([{'regex': pattern, 'action': 'ignore'}])
+        started = time.perf_counter()
+        assert matched(rules, text=text) == []
+        assert time.perf_counter() - started < 0.5